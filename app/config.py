@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic import BaseSettings
 
 
@@ -8,6 +9,17 @@ class Settings(BaseSettings):
     POSTGRES_DB: str
     POSTGRES_HOST: str
     POSTGRES_HOSTNAME: str
+    # Full URLs override the Postgres settings, e.g. sqlite+aiosqlite:// in tests
+    DATABASE_URL: Optional[str] = None
+    ASYNC_DATABASE_URL: Optional[str] = None
+    DATABASE_POOL_SIZE: int = 5
+    DATABASE_MAX_OVERFLOW: int = 10
+    DATABASE_POOL_RECYCLE: int = 1800
+    DATABASE_POOL_PRE_PING: bool = True
+    # Types and extensions are cached per worker, NOTIFY (Postgres only)
+    # invalidates the other workers right away instead of after the TTL
+    REFERENCE_CACHE_TTL: int = 60
+    REFERENCE_CACHE_NOTIFY: bool = False
 
     JWT_SECRET_KEY: str
     REFRESH_TOKEN_EXPIRES_IN: int
@@ -16,6 +28,20 @@ class Settings(BaseSettings):
 
     CLIENT_ORIGIN: str
 
+    # Card rendering, None uses one worker per CPU
+    RENDER_WORKERS: Optional[int] = None
+    RENDER_JOB_TIMEOUT: int = 120
+    PRINT_JOB_WORKERS: int = 2
+    PRINT_ICC_DIR: str = "./app/routers/storybuilders/assets/icc"
+    PRINT_ICC_PROFILE: Optional[str] = None
+    PRINT_JOB_TTL: int = 3600
+    CARD_IMAGE_MAX_AGE: int = 0
+    CARD_IMAGE_MEMORY_BYTES: int = 64 * 1024 * 1024
+    ATLAS_MEMORY_BYTES: int = 64 * 1024 * 1024
+    ATLAS_MAX_CARDS: int = 1024
+    ATLAS_MAX_PIXELS: int = 4096 * 4096
+    ASSET_CHECK_INTERVAL: int = 30
+
     class Config:
         env_file = "./.env"
 
@@ -5,8 +5,16 @@ from fastapi_jwt_auth.exceptions import AuthJWTException
 from fastapi.exceptions import RequestValidationError, StarletteHTTPException
 from fastapi.encoders import jsonable_encoder
 from app.config import settings
+from app.database import engine
 from app.routers import user, auth
 from app.routers.storybuilders import cards, cards_extension, cards_types
+from app.routers.storybuilders.assets import assets
+from app.routers.storybuilders import render_pool
+from app.routers.storybuilders.print_jobs import print_jobs
+from app.routers.storybuilders.invalidation import warmer
+from app.routers.storybuilders.reference_cache import reference_listener
+from app.routers.storybuilders.timing import collect_timings, server_timing_header
+from app.utils import create_card_indexes, create_collection_versions
 
 app = FastAPI()
 
@@ -20,6 +28,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "Link"],
 )
 
 
@@ -38,6 +47,34 @@ app.include_router(
 )
 
 
+@app.on_event("startup")
+def load_assets():
+    create_collection_versions(engine)
+    create_card_indexes(engine)
+    assets.load()
+    print_jobs.sweep_archives()
+    warmer.start()
+    reference_listener.start()
+
+
+@app.on_event("shutdown")
+def shutdown_render_pool():
+    reference_listener.stop()
+    warmer.stop()
+    print_jobs.shutdown()
+    render_pool.shutdown()
+
+
+@app.middleware("http")
+async def server_timing(request: Request, call_next):
+    # Stages timed while handling the request, render workers included
+    with collect_timings() as timings:
+        response = await call_next(request)
+    if timings:
+        response.headers["Server-Timing"] = server_timing_header(timings)
+    return response
+
+
 @app.exception_handler(AuthJWTException)
 def authjwt_exception_handler(request: Request, exc: AuthJWTException):
     return JSONResponse(status_code=exc.status_code, content={"detail": exc.message})
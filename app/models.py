@@ -3,6 +3,7 @@ from .database import Base
 from sqlalchemy import (
     TIMESTAMP,
     Column,
+    Index,
     String,
     Boolean,
     text,
@@ -58,6 +59,13 @@ class User(Base):
     scopes = Column(String, nullable=True, server_default="me")
 
 
+class CollectionVersion(Base):
+    # Changes on every write to the table it names, list ETags are built on it
+    __tablename__ = "collection_versions"
+    name = Column(String, primary_key=True)
+    version = Column(String, nullable=False)
+
+
 class CardType(CustomBase):
     __tablename__ = "types"
     id = Column(Integer, primary_key=True)
@@ -75,6 +83,17 @@ class CardExtension(CustomBase):
 
 class Card(CustomBase):
     __tablename__ = "cards"
+    # Keyset pages of the card list, filtered or not, walk these by id
+    __table_args__ = (
+        Index("ix_cards_card_type_id", "card_type", "id"),
+        Index("ix_cards_extension_id", "extension", "id"),
+        Index("ix_cards_difficulty_id", "difficulty", "id"),
+        Index(
+            "ix_cards_name_prefix",
+            "name",
+            postgresql_ops={"name": "text_pattern_ops"},
+        ),
+    )
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False, unique=True)
     description = Column(String, nullable=False)
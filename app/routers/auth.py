@@ -13,8 +13,10 @@ from pydantic import EmailStr
 
 from app import oauth2
 from .. import schemas, models, utils
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from ..database import get_db
+from ..database import get_async_db, get_db
 from app.oauth2 import AuthJWT, denylist
 from ..config import settings
 
@@ -31,7 +33,7 @@ REFRESH_TOKEN_EXPIRES_IN = settings.REFRESH_TOKEN_EXPIRES_IN
 )
 async def create_user(
     payload: schemas.CreateUserSchema,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
     Authorize: AuthJWT = Depends(),
     user_id: str = Security(oauth2.require_user, scopes=["admin"]),
 ):
@@ -39,11 +41,10 @@ async def create_user(
 
     current_user = Authorize.get_jwt_subject()
     # Check if user already exist
-    user = (
-        db.query(models.User)
-        .filter(models.User.email == EmailStr(payload.email.lower()))
-        .first()
+    result = await db.execute(
+        select(models.User).where(models.User.email == EmailStr(payload.email.lower()))
     )
+    user = result.scalars().first()
     if user:
         raise HTTPException(
             status_code=status.HTTP_409_CONFLICT, detail="Account already exist"
@@ -62,8 +63,8 @@ async def create_user(
     payload.created_by = current_user
     new_user = models.User(**payload.dict())
     db.add(new_user)
-    db.commit()
-    db.refresh(new_user)
+    await db.commit()
+    await db.refresh(new_user)
     return new_user
 
 
@@ -0,0 +1,107 @@
+import hashlib
+import os
+import threading
+from PIL import Image, ImageFont
+from app.routers.storybuilders.timing import stage
+
+ASSETS_DIR = "./app/routers/storybuilders/assets"
+
+# name: (file, resize callback)
+IMAGES = {
+    "contour": ("Contour.png", None),
+    "difficulty": ("Difficulty10X.png", None),
+    "separator": ("CardSeparator2X.png", lambda w, h: (w + 45, h)),
+    "logo": ("Logo2X.png", None),
+}
+FONT_FILE = "fonts/Chewy-Regular.ttf"
+FONT_SIZES = (29, 34, 45)
+
+
+class AssetRegistry:
+    def __init__(self, assets_dir=ASSETS_DIR):
+        self.assets_dir = assets_dir
+        self._version = None
+        self._images = {}
+        self._fonts = {}
+        self._mtimes = {}
+        self._lock = threading.Lock()
+
+    def _path(self, filename):
+        return os.path.join(self.assets_dir, filename)
+
+    def _files(self):
+        return [filename for filename, _ in IMAGES.values()] + [FONT_FILE]
+
+    def load(self):
+        with stage("assets"):
+            self._load()
+
+    def _load(self):
+        images = {}
+        fonts = {}
+        mtimes = {}
+        digest = hashlib.sha1()
+        for filename in self._files():
+            path = self._path(filename)
+            mtimes[filename] = os.stat(path).st_mtime_ns
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        for name, (filename, resize) in IMAGES.items():
+            with Image.open(self._path(filename)) as img:
+                img = img.convert("RGBA")
+            if resize:
+                img = img.resize(resize(*img.size))
+            # Decode once, every renderer works on copies
+            img.readonly = 1
+            images[name] = img
+        for size in FONT_SIZES:
+            fonts[size] = ImageFont.truetype(self._path(FONT_FILE), size)
+        with self._lock:
+            self._images = images
+            self._fonts = fonts
+            self._mtimes = mtimes
+            self._version = digest.hexdigest()[:12]
+
+    def _ensure_loaded(self):
+        if self._version is None:
+            self.load()
+
+    @property
+    def version(self):
+        self._ensure_loaded()
+        return self._version
+
+    def changed(self):
+        for filename, mtime in self._mtimes.items():
+            try:
+                if os.stat(self._path(filename)).st_mtime_ns != mtime:
+                    return True
+            except FileNotFoundError:
+                return True
+        return False
+
+    def reload_if_changed(self):
+        if self._version is None or self.changed():
+            self.load()
+            return True
+        return False
+
+    def image(self, name):
+        self._ensure_loaded()
+        return self._images[name].copy()
+
+    def size(self, name):
+        self._ensure_loaded()
+        return self._images[name].size
+
+    def font(self, size):
+        self._ensure_loaded()
+        if size not in self._fonts:
+            with stage("assets"):
+                font = ImageFont.truetype(self._path(FONT_FILE), size)
+            with self._lock:
+                self._fonts[size] = font
+        return self._fonts[size]
+
+
+assets = AssetRegistry()
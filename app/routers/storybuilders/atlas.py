@@ -0,0 +1,79 @@
+import hashlib
+import io
+import math
+from fastapi import HTTPException, status
+from PIL import Image
+from app.config import settings
+from app.routers.storybuilders.cache import LRUCache
+from app.routers.storybuilders.image_cache import atlas_path, read_file, write_file
+from app.routers.storybuilders.render_pool import render_thumbnails
+
+# Encoded atlases by content key, in front of the disk copies every worker
+# can serve
+atlas_cache = LRUCache(maxsize=256, maxbytes=settings.ATLAS_MEMORY_BYTES)
+
+
+def atlas_key(specs, size):
+    digest = hashlib.sha256(str(size).encode("utf-8"))
+    for spec in specs:
+        digest.update(spec.digest.encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+def atlas_rects(card_ids, size):
+    # Square-ish grid, row by row in the given order
+    cols = max(math.ceil(math.sqrt(len(card_ids))), 1)
+    rows = max(math.ceil(len(card_ids) / cols), 1)
+    rects = {
+        card_id: (size * (i % cols), size * (i // cols), size, size)
+        for i, card_id in enumerate(card_ids)
+    }
+    return (cols * size, rows * size), rects
+
+
+def check_atlas_limits(card_count, atlas_size):
+    width, height = atlas_size
+    if card_count > settings.ATLAS_MAX_CARDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Atlas limited to {settings.ATLAS_MAX_CARDS} cards, "
+            f"got {card_count}, narrow the filters",
+        )
+    if width * height > settings.ATLAS_MAX_PIXELS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Atlas of {width}x{height} pixels is too large, "
+            "use a smaller size or narrow the filters",
+        )
+
+
+def render_atlas(specs, atlas_size, rects, size):
+    atlas = Image.new(mode="RGB", size=atlas_size, color=(255, 255, 255))
+    for card_img, (x, y, _, _) in zip(render_thumbnails(specs, size), rects):
+        atlas.paste(card_img, (x, y))
+    atlas_bytes = io.BytesIO()
+    atlas.save(atlas_bytes, "png", optimize=True)
+    return atlas_bytes.getvalue()
+
+
+def read_atlas(key):
+    data = atlas_cache.get(key)
+    if data is None:
+        data = read_file(atlas_path(key))
+        if data is not None:
+            atlas_cache.set(key, data)
+    return data
+
+
+def get_or_create_atlas(cards, size):
+    # cards: [(card_id, spec), ...]
+    card_ids = [card_id for card_id, _ in cards]
+    specs = [spec for _, spec in cards]
+    key = atlas_key(specs, size)
+    atlas_size, rects = atlas_rects(card_ids, size)
+    check_atlas_limits(len(cards), atlas_size)
+    if read_atlas(key) is None:
+        data = render_atlas(specs, atlas_size, rects.values(), size)
+        write_file(atlas_path(key), data)
+        atlas_cache.set(key, data)
+    return key, atlas_size, rects
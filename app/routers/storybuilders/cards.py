@@ -1,171 +1,462 @@
-from fastapi import APIRouter, Depends, Security
-from fastapi.responses import JSONResponse, FileResponse, StreamingResponse
-from app.database import get_db
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Path,
+    Query,
+    Request,
+    Security,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import (
+    JSONResponse,
+    FileResponse,
+    ORJSONResponse,
+    Response,
+    StreamingResponse,
+)
+from app.database import get_async_db, get_db
+from sqlalchemy import and_
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from app import models, schemas
-from typing import List
-from app.utils import get, create, edit, delete, APIException
+from typing import List, Optional
+from app.config import settings
+from app.utils import (
+    get,
+    create,
+    edit,
+    delete,
+    collection_etag,
+    collection_headers,
+    etag_matches,
+    APIException,
+)
 from PIL import Image
 from app.routers.storybuilders.utils import (
-    generate_recto_card,
-    generate_verso_card,
-    generate_card_prints,
+    get_card_print_specs,
+    get_print_sheets,
+    stream_print_archive,
+)
+from app.routers.storybuilders.image_cache import (
+    get_or_create_rendition,
+    image_cache_headers,
+    image_cache_stats,
+    rendition_etag,
+    rendition_media_type,
+    rendition_params,
+)
+from app.routers.storybuilders.specs import RECTO, VERSO, card_render_spec
+from app.routers.storybuilders.render_pool import (
+    iter_sheets,
+    render_sheets,
+    RenderTimeout,
+)
+from app.routers.storybuilders.print_jobs import print_jobs, DONE
+from app.routers.storybuilders.invalidation import (
+    cards_changed,
+    cards_deleted,
+    note_render,
+)
+from app.routers.storybuilders.atlas import get_or_create_atlas, read_atlas
+from app.routers.storybuilders.timing import histograms, stage
+from app.routers.storybuilders.reference_cache import card_types_cache
+from app.routers.storybuilders.imposition import DEFAULT_PAPER, PAPER_PROFILES
+from app.routers.storybuilders.print_color import (
+    FORMATS,
+    PrintOutput,
+    available_profiles,
 )
-import io
-import os
-import datetime
-import tarfile
 
 router = APIRouter()
 
 # Cards
 
 
+CARD_FIELDS = tuple(schemas.CardResponse.__fields__)
+CARD_PAGE_DEFAULT = 100
+CARD_PAGE_MAX = 1000
+
+
+def card_filters(
+    card_type: Optional[int] = None,
+    extension: Optional[int] = None,
+    min_difficulty: Optional[int] = None,
+    max_difficulty: Optional[int] = None,
+    name_prefix: Optional[str] = None,
+):
+    conditions = []
+    if card_type is not None:
+        conditions.append(models.Card.card_type == card_type)
+    if extension is not None:
+        conditions.append(models.Card.extension == extension)
+    if min_difficulty is not None:
+        conditions.append(models.Card.difficulty >= min_difficulty)
+    if max_difficulty is not None:
+        conditions.append(models.Card.difficulty <= max_difficulty)
+    if name_prefix:
+        conditions.append(models.Card.name.startswith(name_prefix, autoescape=True))
+    return conditions
+
+
+def card_fields(fields: Optional[str] = None):
+    # Comma separated, e.g. fields=name,difficulty
+    if not fields:
+        return list(CARD_FIELDS)
+    selected = [field.strip() for field in fields.split(",") if field.strip()]
+    unknown = [field for field in selected if field not in CARD_FIELDS]
+    if unknown:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields '{', '.join(unknown)}'",
+        )
+    # Cursors are ids, every row keeps its id
+    return ["id"] + [field for field in selected if field != "id"]
+
+
 @router.get("/get", response_model=schemas.CardCollection)
 def get_cards(
+    request: Request,
+    cursor: Optional[int] = None,
+    limit: int = Query(CARD_PAGE_DEFAULT, ge=1, le=CARD_PAGE_MAX),
+    conditions: list = Depends(card_filters),
+    fields: list = Depends(card_fields),
+    if_none_match: Optional[str] = Header(None),
     db: Session = Depends(get_db),
 ):
-    return {"__root__": get(db, models.Card, models.Card.id)}
+    # Every page and filter of the list shares the table's version
+    headers = collection_headers(collection_etag(db, models.Card))
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    # Keyset pages by id, the next cursor is sent in X-Next-Cursor and Link
+    if cursor is not None:
+        conditions.append(models.Card.id > cursor)
+    rows = get(
+        db,
+        models.Card,
+        models.Card.id,
+        and_(*conditions) if conditions else None,
+        fields,
+        limit + 1,
+    )
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = rows[-1]["id"]
+        next_url = request.url.include_query_params(cursor=next_cursor)
+        headers["X-Next-Cursor"] = str(next_cursor)
+        headers["Link"] = f'<{next_url}>; rel="next"'
+    # Rows already match the response schema, skip its validation
+    return ORJSONResponse(rows, headers=headers)
 
 
 @router.post(
     "/create",
     response_model=schemas.CardCollection,
-    responses={401: {"model": schemas.DefaultResponse}},
+    responses={401: {"model": schemas.ConflictResponse}},
 )
 async def create_card(
     payload: schemas.CardBaseCollection,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     try:
-        return {"__root__": create(db, models.Card, payload.dict())}
+        items = await create(db, models.Card, payload.dict())
     except APIException as e:
-        db.rollback()
+        await db.rollback()
         return JSONResponse(
             status_code=401,
             content={
                 "message": "An error occured : '{}' card already exist.".format(
-                    e.item["name"]
-                )
+                    "', '".join(item["name"] for item in e.item)
+                ),
+                "conflicts": e.item,
             },
         )
+    # Index lookups and image evictions block, keep them off the event loop
+    await run_in_threadpool(
+        cards_changed,
+        [(item["id"], item["card_type"], item["extension"]) for item in items],
+    )
+    return {"__root__": items}
 
 
-@router.post("/edit", response_model=schemas.CardCollection)
-async def edit_card(payload: schemas.CardCollection, db: Session = Depends(get_db)):
+@router.post(
+    "/edit",
+    response_model=schemas.CardEditResponse,
+    responses={401: {"model": schemas.ConflictResponse}},
+)
+async def edit_card(
+    payload: schemas.CardCollection, db: AsyncSession = Depends(get_async_db)
+):
     datas = payload.dict()
-    # Invalid card images
-    for card in datas["__root__"]:
-        card_id = card["id"]
-        if os.path.isfile(
-            f"./app/routers/storybuilders/generated/cards/card_{card_id}_0.png"
-        ):
-            os.remove(
-                f"./app/routers/storybuilders/generated/cards/card_{card_id}_0.png"
-            )
-        if os.path.isfile(
-            f"./app/routers/storybuilders/generated/cards/card_{card_id}_1.png"
-        ):
-            os.remove(
-                f"./app/routers/storybuilders/generated/cards/card_{card_id}_1.png"
-            )
-    return edit(db, models.Card, datas, "id")
+    try:
+        response = await edit(db, models.Card, datas, "id")
+    except APIException as e:
+        return JSONResponse(
+            status_code=401,
+            content={
+                "message": "An error occured : '{}' card already exist.".format(
+                    "', '".join(item["name"] for item in e.item)
+                ),
+                "conflicts": e.item,
+            },
+        )
+    await run_in_threadpool(
+        cards_changed,
+        [
+            (card["id"], card["card_type"], card["extension"])
+            for card in response["updated"]
+        ],
+    )
+    return response
 
 
 @router.post("/delete", response_model=schemas.DefaultResponse)
-async def delete_card(payload: schemas.DeleteId, db: Session = Depends(get_db)):
+async def delete_card(
+    payload: schemas.DeleteId, db: AsyncSession = Depends(get_async_db)
+):
     data = payload.dict()
-    card_id = data["id"]
-    # Delete card images
-    if os.path.isfile(
-        f"./app/routers/storybuilders/generated/cards/card_{card_id}_0.png"
-    ):
-        os.remove(f"./app/routers/storybuilders/generated/cards/card_{card_id}_0.png")
-    if os.path.isfile(
-        f"./app/routers/storybuilders/generated/cards/card_{card_id}_1.png"
-    ):
-        os.remove(f"./app/routers/storybuilders/generated/cards/card_{card_id}_1.png")
-    return delete(db, models.Card, (models.Card.id == card_id))
-
-
-def get_or_create_card_image(db, face, card_id):
-    if os.path.isfile(
-        f"./app/routers/storybuilders/generated/cards/card_{card_id}_{face}.png"
-    ):
-        f = open(
-            f"./app/routers/storybuilders/generated/cards/card_{card_id}_{face}.png",
-            "rb",
+    response = await delete(db, models.Card, (models.Card.id == data["id"]))
+    await run_in_threadpool(cards_deleted, [data["id"]])
+    return response
+
+
+def get_card_render_spec(db, card_id, face):
+    with stage("db"):
+        card = db.query(models.Card).filter(models.Card.id == card_id).first()
+    card_type = card and card_types_cache.get(db, card.card_type)
+    if not card_type:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Card not found"
         )
-        return f
-    card, card_type = (
-        db.query(models.Card, models.CardType)
-        .join(models.CardType)
-        .filter(models.Card.id == card_id)
-        .first()
-    )
-    if face == 0:
-        card_img = generate_recto_card(card, card_type)
-    else:
-        card_img = generate_verso_card(card, card_type)
-
-    card_bytes = io.BytesIO()
-    card_img.save(
-        f"./app/routers/storybuilders/generated/cards/card_{card_id}_{face}.png", "png"
+    return card_render_spec(card, card_type, face)
+
+
+@router.get("/image/{card_id}/{face}", response_class=Response)
+def get_image(
+    card_id: int,
+    face: int = Path(..., ge=RECTO, le=VERSO),
+    rendition: tuple = Depends(rendition_params),
+    if_none_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
+    size, image_format = rendition
+    spec = get_card_render_spec(db, card_id, face)
+    note_render(card_id, spec)
+    etag = rendition_etag(spec, size, image_format)
+    headers = image_cache_headers(etag)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    data = get_or_create_rendition(spec, size, image_format)
+    return Response(
+        data, media_type=rendition_media_type(image_format), headers=headers
     )
-    card_img.save(card_bytes, "png")
-    card_bytes.seek(0)
-    return card_bytes
 
 
-@router.get("/image/{card_id}/{face}", response_class=StreamingResponse)
-def get_image(card_id: int, face: int, db: Session = Depends(get_db)):
+@router.get("/image_cache/stats")
+def get_image_cache_stats():
+    return image_cache_stats()
+
 
-    data = get_or_create_card_image(db, face, card_id)
-    return StreamingResponse(data, media_type="image/png")
+@router.get("/render_timings")
+def get_render_timings():
+    # Per-stage histograms since startup, render workers included
+    return histograms.snapshot()
 
 
-@router.get("/generate_print/{start_id}/{end_id}", response_class=FileResponse)
-async def generate_print(start_id: int, end_id: int, db: Session = Depends(get_db)):
-    i = start_id
-    card_prints = []
-    while i <= end_id:
-        # print(i, (i + 11 if i + 11 < end_id else end_id))
-        card_prints.append(
-            generate_card_prints(i, (i + 11 if i + 11 < end_id else end_id), db)
+def render_print_sheets(sheets):
+    try:
+        return render_sheets(sheets)
+    except RenderTimeout:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Print rendering timed out",
         )
-        i = i + 11
-    f_name = f"./app/routers/storybuilders/generated/generated_prints_{start_id}_{end_id}_{datetime.datetime.now().timestamp()}.tar.gz"
-    tar = tarfile.open(
-        f_name,
-        "w:gz",
+
+
+def check_paper(paper):
+    if paper not in PAPER_PROFILES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown paper '{paper}'",
+        )
+
+
+def check_print_output(output_profile, sheet_format, quality):
+    if sheet_format not in FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown format '{sheet_format}'",
+        )
+    profile = output_profile or settings.PRINT_ICC_PROFILE
+    if profile and profile not in available_profiles():
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown ICC profile '{profile}'",
+        )
+    return PrintOutput(profile=profile, format=sheet_format, quality=quality)
+
+
+def print_output(
+    output_profile: Optional[str] = None,
+    format: str = "jpeg",
+    quality: int = Query(75, ge=1, le=100),
+):
+    return check_print_output(output_profile, format, quality)
+
+
+def print_filters(
+    extension: Optional[int] = None,
+    card_type: Optional[int] = None,
+    ids: Optional[List[int]] = Query(None),
+):
+    return {"extension": extension, "card_type": card_type, "ids": ids}
+
+
+@router.get("/generate_print/{start_id}/{end_id}", response_class=StreamingResponse)
+def generate_print(
+    start_id: int,
+    end_id: int,
+    paper: str = DEFAULT_PAPER,
+    output: PrintOutput = Depends(print_output),
+    filters: dict = Depends(print_filters),
+    db: Session = Depends(get_db),
+):
+    check_paper(paper)
+    sheets = get_print_sheets(
+        db, paper, output, start_id=start_id, end_id=end_id, **filters
     )
-    for filename in card_prints:
-        recto = open(filename[0][1], "rb")
-        recto_tar_info = tarfile.TarInfo(filename[0][0])
-        recto_tar_info.size = os.path.getsize(filename[0][1])
-        tar.addfile(recto_tar_info, recto)
-        verso = open(filename[1][1], "rb")
-        verso_tar_info = tarfile.TarInfo(filename[1][0])
-        verso_tar_info.size = os.path.getsize(filename[1][1])
-        tar.addfile(verso_tar_info, verso)
-    tar.close()
-    f = open(
-        f_name,
-        "rb",
+    response = StreamingResponse(
+        stream_print_archive(iter_sheets(sheets)), media_type="application/x-tgz"
     )
-    response = StreamingResponse(f, media_type="application/x-tgz")
     response.headers[
         "Content-Disposition"
     ] = f"attachment; filename=generated_prints_{start_id}_{end_id}.tar.gz"
     return response
 
 
-@router.get(
-    "/generate_print_img/{start_id}/{end_id}/{face}", response_class=FileResponse
-)
-async def generate_print(
-    start_id: int, end_id: int, face: int, db: Session = Depends(get_db)
+@router.get("/generate_print_img/{start_id}/{end_id}/{face}", response_class=Response)
+def generate_print_img(
+    start_id: int,
+    end_id: int,
+    face: int = Path(..., ge=RECTO, le=VERSO),
+    paper: str = DEFAULT_PAPER,
+    output: PrintOutput = Depends(print_output),
+    filters: dict = Depends(print_filters),
+    db: Session = Depends(get_db),
+):
+    check_paper(paper)
+    sheets = get_print_sheets(
+        db, paper, output, start_id=start_id, end_id=end_id, **filters
+    )
+    if not sheets:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="No cards to print"
+        )
+    # Only the first sheet of the selection
+    card_prints = render_print_sheets(sheets[:1])[0]
+    return Response(card_prints[face][1], media_type=output.media_type)
+
+
+# Atlas
+
+
+@router.get("/atlas", response_model=schemas.CardAtlas)
+def get_atlas(
+    request: Request,
+    face: int = Query(RECTO, ge=RECTO, le=VERSO),
+    size: int = Query(100, ge=16, le=400),
+    filters: dict = Depends(print_filters),
+    db: Session = Depends(get_db),
 ):
-    filenames = generate_card_prints(start_id, end_id, db)
-    f = open(filenames[face][1], "rb")
-    return StreamingResponse(f, media_type="image/png")
+    cards = [
+        (card_id, spec.for_face(face))
+        for card_id, spec in get_card_print_specs(db, **filters)
+    ]
+    if not cards:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="No cards")
+    try:
+        key, (width, height), rects = get_or_create_atlas(cards, size)
+    except RenderTimeout:
+        raise HTTPException(
+            status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+            detail="Atlas rendering timed out",
+        )
+    return {
+        "key": key,
+        "image": request.url_for("get_atlas_image", key=key),
+        "width": width,
+        "height": height,
+        "rects": rects,
+    }
+
+
+@router.get("/atlas/{key}", response_class=Response)
+def get_atlas_image(
+    key: str = Path(..., regex="^[0-9a-f]{32}$"),
+    if_none_match: Optional[str] = Header(None),
+):
+    # Atlases are content addressed, their bytes never change
+    headers = {
+        "ETag": f'"{key}"',
+        "Cache-Control": "public, max-age=31536000, immutable",
+    }
+    if etag_matches(if_none_match, f'"{key}"'):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    data = read_atlas(key)
+    if data is None:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Atlas expired"
+        )
+    return Response(data, media_type="image/png", headers=headers)
+
+
+# Print jobs
+
+
+def get_print_job(job_id):
+    job = print_jobs.get(job_id)
+    if not job:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Print job not found"
+        )
+    return job
+
+
+@router.post(
+    "/print_jobs",
+    response_model=schemas.PrintJobResponse,
+    status_code=status.HTTP_202_ACCEPTED,
+)
+def create_print_job(payload: schemas.PrintJobCreate, db: Session = Depends(get_db)):
+    filters = payload.dict()
+    paper = filters.pop("paper")
+    check_paper(paper)
+    output = check_print_output(
+        filters.pop("output_profile"), filters.pop("format"), filters.pop("quality")
+    )
+    sheets = get_print_sheets(db, paper, output, **filters)
+    name = "generated_prints"
+    if payload.start_id is not None or payload.end_id is not None:
+        name = f"generated_prints_{payload.start_id or ''}_{payload.end_id or ''}"
+    job = print_jobs.submit(name, sheets)
+    return job.to_dict()
+
+
+@router.get("/print_jobs/{job_id}", response_model=schemas.PrintJobResponse)
+def get_print_job_status(job_id: str):
+    return get_print_job(job_id).to_dict()
+
+
+@router.get("/print_jobs/{job_id}/result", response_class=FileResponse)
+def get_print_job_result(job_id: str):
+    job = get_print_job(job_id)
+    if job.status != DONE:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Print job is {job.status}",
+        )
+    return FileResponse(
+        job.result_path, media_type="application/x-tgz", filename=job.filename
+    )
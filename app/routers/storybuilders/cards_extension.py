@@ -1,10 +1,27 @@
-from fastapi import APIRouter, Depends, Security
-from fastapi.responses import JSONResponse
-from app.database import get_db
+from fastapi import APIRouter, Depends, Header, Security, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
+from app.database import get_async_db, get_db
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from app import models, schemas
-from typing import List
-from app.utils import get, create, edit, delete, APIException
+from typing import List, Optional
+from app.utils import (
+    create,
+    edit,
+    delete,
+    collection_headers,
+    etag_matches,
+    APIException,
+)
+from app.routers.storybuilders.invalidation import (
+    extensions_changed,
+    extensions_deleted,
+)
+from app.routers.storybuilders.reference_cache import (
+    extensions_cache,
+    reference_changed,
+)
 
 
 router = APIRouter()
@@ -12,43 +29,80 @@ router = APIRouter()
 
 @router.get("/get", response_model=schemas.ExtensionResponseCollection)
 def get_cards_extension(
+    if_none_match: Optional[str] = Header(None),
     db: Session = Depends(get_db),
 ):
-    return {"__root__": get(db, models.CardExtension)}
+    etag, rows = extensions_cache.rows(db)
+    headers = collection_headers(etag)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return ORJSONResponse(rows, headers=headers)
 
 
 @router.post(
     "/create",
     response_model=schemas.ExtensionResponseCollection,
-    responses={411: {"model": schemas.DefaultResponse}},
+    responses={411: {"model": schemas.ConflictResponse}},
 )
 async def create_card_extension(
     payload: schemas.ExtensionBaseCollection,
-    db: Session = Depends(get_db),
+    db: AsyncSession = Depends(get_async_db),
 ):
     try:
-        return {"__root__": create(db, models.CardExtension, payload.dict())}
+        items = await create(db, models.CardExtension, payload.dict())
     except APIException as e:
-        db.rollback()
+        await db.rollback()
         return JSONResponse(
             status_code=411,
             content={
                 "message": "An error occured : '{}' extension already exist.".format(
-                    e.item["name"]
-                )
+                    "', '".join(item["name"] for item in e.item)
+                ),
+                "conflicts": e.item,
             },
         )
+    await reference_changed(db, extensions_cache)
+    return {"__root__": items}
 
 
-@router.post("/edit", response_model=schemas.ExtensionResponseCollection)
+@router.post(
+    "/edit",
+    response_model=schemas.ExtensionEditResponse,
+    responses={411: {"model": schemas.ConflictResponse}},
+)
 async def edit_card(
-    payload: schemas.ExtensionResponseCollection, db: Session = Depends(get_db)
+    payload: schemas.ExtensionResponseCollection,
+    db: AsyncSession = Depends(get_async_db),
 ):
     data = payload.dict()
-    return edit(db, models.CardExtension, data, "id")
+    try:
+        response = await edit(db, models.CardExtension, data, "id")
+    except APIException as e:
+        return JSONResponse(
+            status_code=411,
+            content={
+                "message": "An error occured : '{}' extension already exist.".format(
+                    "', '".join(item["name"] for item in e.item)
+                ),
+                "conflicts": e.item,
+            },
+        )
+    if response["updated"]:
+        await reference_changed(db, extensions_cache)
+    await run_in_threadpool(
+        extensions_changed, [extension["id"] for extension in response["updated"]]
+    )
+    return response
 
 
 @router.post("/delete", response_model=schemas.DefaultResponse)
-async def delete_card(payload: schemas.DeleteId, db: Session = Depends(get_db)):
+async def delete_card(
+    payload: schemas.DeleteId, db: AsyncSession = Depends(get_async_db)
+):
     data = payload.dict()
-    return delete(db, models.CardExtension, (models.CardExtension.id == data["id"]))
+    response = await delete(
+        db, models.CardExtension, (models.CardExtension.id == data["id"])
+    )
+    await reference_changed(db, extensions_cache)
+    await run_in_threadpool(extensions_deleted, [data["id"]])
+    return response
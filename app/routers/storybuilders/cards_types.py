@@ -1,15 +1,50 @@
-from fastapi import APIRouter, Depends, Security
-from fastapi.responses import JSONResponse, StreamingResponse
-from app.database import get_db, Base
+from fastapi import (
+    APIRouter,
+    Depends,
+    Header,
+    HTTPException,
+    Path,
+    Query,
+    Security,
+    status,
+)
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, ORJSONResponse, Response
+from app.database import get_async_db, get_db, Base
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 from app import models, schemas
-from app.utils import get, create, edit, delete, APIException
-from app.routers.storybuilders.utils import (
-    generate_recto_card,
-    generate_verso_card,
+from typing import Optional
+from app.utils import (
+    create,
+    edit,
+    delete,
+    collection_headers,
+    etag_matches,
+    APIException,
+)
+from app.routers.storybuilders.specs import (
+    RECTO,
+    VERSO,
+    TYPE_PREVIEW_DIFFICULTY,
+    type_preview_spec,
+)
+from app.routers.storybuilders.image_cache import (
+    get_or_create_rendition,
+    image_cache_headers,
+    rendition_etag,
+    rendition_media_type,
+    rendition_params,
+)
+from app.routers.storybuilders.invalidation import (
+    note_type_preview,
+    types_changed,
+    types_deleted,
+)
+from app.routers.storybuilders.reference_cache import (
+    card_types_cache,
+    reference_changed,
 )
-from random import randrange
-import io
 
 router = APIRouter()
 
@@ -18,53 +53,105 @@ router = APIRouter()
 
 
 @router.get("/get", response_model=schemas.CardTypeResponseCollection)
-def get_card_types(db: Session = Depends(get_db)):
-    return {"__root__": get(db, models.CardType, models.CardType.id)}
+def get_card_types(
+    if_none_match: Optional[str] = Header(None), db: Session = Depends(get_db)
+):
+    etag, rows = card_types_cache.rows(db)
+    headers = collection_headers(etag)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    return ORJSONResponse(rows, headers=headers)
 
 
-@router.post("/create", response_model=schemas.CardTypeResponseCollection)
+@router.post(
+    "/create",
+    response_model=schemas.CardTypeResponseCollection,
+    responses={411: {"model": schemas.ConflictResponse}},
+)
 async def create_card_type(
-    payload: schemas.CardTypeCollection, db: Session = Depends(get_db)
+    payload: schemas.CardTypeCollection, db: AsyncSession = Depends(get_async_db)
 ):
     try:
-        return create(db, models.CardType, payload.dict())
+        items = await create(db, models.CardType, payload.dict())
     except APIException as e:
-        db.rollback()
+        await db.rollback()
         return JSONResponse(
             status_code=411,
             content={
                 "message": "An error occured : '{}' type already exist.".format(
-                    e.item["name"]
-                )
+                    "', '".join(item["name"] for item in e.item)
+                ),
+                "conflicts": e.item,
             },
         )
+    await reference_changed(db, card_types_cache)
+    return items
 
 
-@router.post("/edit", response_model=schemas.CardTypeResponseCollection)
+@router.post(
+    "/edit",
+    response_model=schemas.CardTypeEditResponse,
+    responses={411: {"model": schemas.ConflictResponse}},
+)
 async def edit_card(
-    payload: schemas.CardTypeResponseCollection, db: Session = Depends(get_db)
+    payload: schemas.CardTypeResponseCollection,
+    db: AsyncSession = Depends(get_async_db),
 ):
     data = payload.dict()
-    print(data)
-    return edit(db, models.CardType, data, "id")
+    try:
+        response = await edit(db, models.CardType, data, "id")
+    except APIException as e:
+        return JSONResponse(
+            status_code=411,
+            content={
+                "message": "An error occured : '{}' type already exist.".format(
+                    "', '".join(item["name"] for item in e.item)
+                ),
+                "conflicts": e.item,
+            },
+        )
+    if response["updated"]:
+        await reference_changed(db, card_types_cache)
+    await run_in_threadpool(
+        types_changed, [card_type["id"] for card_type in response["updated"]]
+    )
+    return response
 
 
 @router.post("/delete", response_model=schemas.DefaultResponse)
-async def delete_card(payload: schemas.DeleteId, db: Session = Depends(get_db)):
+async def delete_card(
+    payload: schemas.DeleteId, db: AsyncSession = Depends(get_async_db)
+):
     data = payload.dict()
-    return delete(db, models.CardType, (models.CardType.id == data["id"]))
-
+    response = await delete(db, models.CardType, (models.CardType.id == data["id"]))
+    await reference_changed(db, card_types_cache)
+    await run_in_threadpool(types_deleted, [data["id"]])
+    return response
 
-@router.get("/image/{type_id}/{face}", response_class=StreamingResponse)
-def get_image(type_id: int, face: int, db: Session = Depends(get_db)):
-    card_type = db.query(models.CardType).filter(models.CardType.id == type_id).first()
-    template_card = models.Card(name="Template", difficulty=randrange(1, 5))
-    if face == 0:
-        card_type_img = generate_recto_card(template_card, card_type)
-    else:
-        card_type_img = generate_verso_card(template_card, card_type)
 
-    card_type_bytes = io.BytesIO()
-    card_type_img.save(card_type_bytes, "png", dpi=(300, 300))
-    card_type_bytes.seek(0)
-    return StreamingResponse(card_type_bytes, media_type="image/png")
+@router.get("/image/{type_id}/{face}", response_class=Response)
+def get_image(
+    type_id: int,
+    face: int = Path(..., ge=RECTO, le=VERSO),
+    difficulty: int = Query(TYPE_PREVIEW_DIFFICULTY, ge=1, le=5),
+    rendition: tuple = Depends(rendition_params),
+    if_none_match: Optional[str] = Header(None),
+    db: Session = Depends(get_db),
+):
+    size, image_format = rendition
+    card_type = card_types_cache.get(db, type_id)
+    if not card_type:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Card type not found"
+        )
+    # Same type, face, difficulty and assets: same preview, cached like a card
+    spec = type_preview_spec(card_type, face, difficulty)
+    note_type_preview(type_id, spec)
+    etag = rendition_etag(spec, size, image_format)
+    headers = image_cache_headers(etag)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    data = get_or_create_rendition(spec, size, image_format)
+    return Response(
+        data, media_type=rendition_media_type(image_format), headers=headers
+    )
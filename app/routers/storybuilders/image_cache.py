@@ -0,0 +1,220 @@
+import glob
+import io
+import os
+import tempfile
+from fastapi import HTTPException, status
+from PIL import Image
+from app.config import settings
+from app.routers.storybuilders.cache import LRUCache
+from app.routers.storybuilders.specs import CardRenderSpec
+from app.routers.storybuilders.timing import stage
+from app.routers.storybuilders.utils import render_card
+
+CARDS_DIR = "./app/routers/storybuilders/generated/cards"
+
+SIZE_PRESETS = {
+    "full": 400,
+    "medium": 200,
+    "small": 100,
+    "thumb": 64,
+}
+# format: (PIL format, media type, save options)
+IMAGE_FORMATS = {
+    "png": ("png", "image/png", {"optimize": True}),
+    "webp": ("webp", "image/webp", {"quality": 80, "method": 4}),
+    "jpeg": ("jpeg", "image/jpeg", {"quality": 85, "optimize": True}),
+}
+MASTER = ("full", "png")
+
+# Hot tier: encoded images by content key, bounded by their total size
+memory_cache = LRUCache(maxsize=100_000, maxbytes=settings.CARD_IMAGE_MEMORY_BYTES)
+disk_stats = {"hits": 0, "misses": 0, "writes": 0}
+
+
+def card_image_path(key, image_format="png"):
+    return f"{CARDS_DIR}/card_{key}.{image_format}"
+
+
+def atlas_path(key):
+    return f"{CARDS_DIR}/atlas_{key}.png"
+
+
+def read_file(path):
+    try:
+        with stage("disk_read"), open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def write_file(path, data):
+    with stage("disk_write"):
+        os.makedirs(CARDS_DIR, exist_ok=True)
+        # Write a private temp file then rename, so concurrent readers never
+        # see a partial file and concurrent writers never share a temp file.
+        # Hidden name, the eviction globs don't match it.
+        fd, tmp_path = tempfile.mkstemp(dir=CARDS_DIR, prefix=".card_", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+def read_card_image(key, image_format="png"):
+    return read_file(card_image_path(key, image_format))
+
+
+def write_card_image(key, data, image_format="png"):
+    write_file(card_image_path(key, image_format), data)
+    disk_stats["writes"] += 1
+
+
+def has_card_image(key, image_format="png"):
+    return (key, image_format) in memory_cache or os.path.isfile(
+        card_image_path(key, image_format)
+    )
+
+
+def store_card_image(key, data, image_format="png"):
+    write_card_image(key, data, image_format)
+    memory_cache.set((key, image_format), data)
+
+
+def evict_card_images(digest):
+    # Drops the master and every rendition of one render spec digest
+    memory_cache.invalidate_where(lambda key: key[0].split("_")[0] == digest)
+    for path in glob.glob(f"{CARDS_DIR}/card_{digest}[._]*"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def sweep_card_images(asset_version):
+    # Every digest covers the asset version, so once the assets change no
+    # cached image can be served again, whichever process wrote it. The
+    # version the directory was filled with is kept next to the images.
+    marker = f"{CARDS_DIR}/.asset_version"
+    try:
+        with open(marker) as f:
+            if f.read() == asset_version:
+                return
+    except FileNotFoundError:
+        pass
+    paths = glob.glob(f"{CARDS_DIR}/card_*") + glob.glob(f"{CARDS_DIR}/atlas_*")
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    os.makedirs(CARDS_DIR, exist_ok=True)
+    with open(marker, "w") as f:
+        f.write(asset_version)
+
+
+def get_or_create_cached(key, image_format, factory):
+    data = memory_cache.get((key, image_format))
+    if data is not None:
+        return data
+    data = read_card_image(key, image_format)
+    if data is None:
+        disk_stats["misses"] += 1
+        data = factory()
+        write_card_image(key, data, image_format)
+    else:
+        disk_stats["hits"] += 1
+    memory_cache.set((key, image_format), data)
+    return data
+
+
+def encode_image(img, size="full", image_format="png"):
+    if SIZE_PRESETS[size] != img.width:
+        with stage("resize"):
+            img = img.resize((SIZE_PRESETS[size], SIZE_PRESETS[size]), Image.LANCZOS)
+    pil_format, _, options = IMAGE_FORMATS[image_format]
+    img_bytes = io.BytesIO()
+    with stage("encode"):
+        img.save(img_bytes, pil_format, **options)
+    return img_bytes.getvalue()
+
+
+def encode_card_image(spec: CardRenderSpec):
+    card_img = render_card(spec)
+    card_bytes = io.BytesIO()
+    with stage("encode"):
+        card_img.save(card_bytes, "png")
+    return card_bytes.getvalue()
+
+
+def get_or_create_card_image(spec: CardRenderSpec):
+    return get_or_create_cached(spec.digest, "png", lambda: encode_card_image(spec))
+
+
+def card_thumbnail(spec: CardRenderSpec, size):
+    # Runs in a render worker, only the small image travels back. Workers
+    # share the disk tier but keep no memory tier of their own.
+    data = read_card_image(spec.digest)
+    if data is None:
+        data = encode_card_image(spec)
+        write_card_image(spec.digest, data)
+    master = Image.open(io.BytesIO(data))
+    with stage("resize"):
+        return master.convert("RGB").resize((size, size), Image.LANCZOS)
+
+
+def rendition_key(spec: CardRenderSpec, size, image_format):
+    if (size, image_format) == MASTER:
+        return spec.digest
+    return f"{spec.digest}_{size}"
+
+
+def rendition_etag(spec: CardRenderSpec, size, image_format):
+    if (size, image_format) == MASTER:
+        return f'"{spec.digest}"'
+    return f'"{rendition_key(spec, size, image_format)}.{image_format}"'
+
+
+def image_cache_headers(etag):
+    return {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={settings.CARD_IMAGE_MAX_AGE}, must-revalidate",
+    }
+
+
+def rendition_params(size: str = "full", format: str = "png"):
+    if size not in SIZE_PRESETS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown size '{size}'",
+        )
+    if format not in IMAGE_FORMATS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown format '{format}'",
+        )
+    return size, format
+
+
+def rendition_media_type(image_format):
+    return IMAGE_FORMATS[image_format][1]
+
+
+def get_or_create_rendition(spec: CardRenderSpec, size="full", image_format="png"):
+    if (size, image_format) == MASTER:
+        return get_or_create_card_image(spec)
+
+    # Every rendition is derived from the cached master, never re-rendered
+    def create():
+        master = Image.open(io.BytesIO(get_or_create_card_image(spec)))
+        return encode_image(master.convert("RGB"), size, image_format)
+
+    return get_or_create_cached(
+        rendition_key(spec, size, image_format), image_format, create
+    )
+
+
+def image_cache_stats():
+    return {"memory": memory_cache.stats(), "disk": dict(disk_stats)}
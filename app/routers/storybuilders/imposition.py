@@ -0,0 +1,72 @@
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Tuple
+
+# Size of the card renders, in pixels
+CARD_RENDER_SIZE = 400
+
+
+@dataclass(frozen=True)
+class PaperProfile:
+    width_mm: float
+    height_mm: float
+    dpi: int = 200
+    card_mm: float = 50.8
+    bleed_mm: float = 0
+    margin_mm: float = 3
+
+
+PAPER_PROFILES = {
+    "letter": PaperProfile(width_mm=215.9, height_mm=279.4),
+    "a4": PaperProfile(width_mm=210, height_mm=297),
+    "a3": PaperProfile(width_mm=297, height_mm=420),
+}
+DEFAULT_PAPER = "letter"
+
+
+@dataclass(frozen=True)
+class SheetLayout:
+    size: Tuple[int, int]
+    card_size: int
+    recto_slots: Tuple[Tuple[int, int], ...]
+    verso_slots: Tuple[Tuple[int, int], ...]
+
+    @property
+    def capacity(self):
+        return len(self.recto_slots)
+
+
+def mm_to_px(mm, dpi):
+    return round(mm * dpi / 25.4)
+
+
+@lru_cache(maxsize=None)
+def sheet_layout(paper=DEFAULT_PAPER):
+    profile = PAPER_PROFILES[paper]
+    width = mm_to_px(profile.width_mm, profile.dpi)
+    height = mm_to_px(profile.height_mm, profile.dpi)
+    card = mm_to_px(profile.card_mm, profile.dpi)
+    bleed = mm_to_px(profile.bleed_mm, profile.dpi)
+    margin = mm_to_px(profile.margin_mm, profile.dpi)
+    pitch = card + 2 * bleed
+    cols = max((width - 2 * margin) // pitch, 0)
+    rows = max((height - 2 * margin) // pitch, 0)
+    if not cols or not rows:
+        raise ValueError(f"'{paper}' paper can't fit a single card")
+    # Centre the grid on the sheet
+    left = (width - cols * pitch) // 2 + bleed
+    top = (height - rows * pitch) // 2 + bleed
+    recto_slots = tuple(
+        (left + col * pitch, top + row * pitch)
+        for row in range(rows)
+        for col in range(cols)
+    )
+    # Backs are mirrored around the long edge for duplex printing
+    verso_slots = tuple((width - x - card, y) for x, y in recto_slots)
+    return SheetLayout((width, height), card, recto_slots, verso_slots)
+
+
+def impose(items, paper=DEFAULT_PAPER):
+    # Packs items densely, every sheet but the last one is full
+    capacity = sheet_layout(paper).capacity
+    return [items[i : i + capacity] for i in range(0, len(items), capacity)]
@@ -0,0 +1,244 @@
+import logging
+import queue
+import threading
+from app import models
+from app.config import settings
+from app.database import SessionLocal
+from app.routers.storybuilders.assets import assets
+from app.routers.storybuilders.reference_cache import card_types_cache
+from app.routers.storybuilders.image_cache import (
+    evict_card_images,
+    has_card_image,
+    store_card_image,
+    sweep_card_images,
+)
+from app.routers.storybuilders.render_pool import encode_cards, RenderTimeout
+from app.routers.storybuilders.specs import RECTO, VERSO, card_render_spec
+
+FACES = (RECTO, VERSO)
+WARM_BATCH_SIZE = 64
+
+logger = logging.getLogger(__name__)
+
+
+class RenderIndex:
+    # What each card render depends on, and the digests currently cached.
+    # Only digests served by this process are known: a card edited on another
+    # worker or before a restart leaves its old images on disk until the next
+    # asset change sweeps them.
+    def __init__(self):
+        self._cards = None
+        self._digests = {}
+        self._type_previews = {}
+        self._lock = threading.RLock()
+
+    def load(self, db):
+        rows = db.query(
+            models.Card.id, models.Card.card_type, models.Card.extension
+        ).all()
+        with self._lock:
+            self._cards = {
+                card_id: (card_type, extension)
+                for card_id, card_type, extension in rows
+            }
+
+    def _ensure_loaded(self):
+        if self._cards is None:
+            db = SessionLocal()
+            try:
+                self.load(db)
+            finally:
+                db.close()
+
+    def set_cards(self, cards):
+        self._ensure_loaded()
+        with self._lock:
+            for card_id, card_type, extension in cards:
+                self._cards[card_id] = (card_type, extension)
+
+    def remove_cards(self, card_ids):
+        self._ensure_loaded()
+        digests = []
+        with self._lock:
+            for card_id in card_ids:
+                self._cards.pop(card_id, None)
+                digests.extend(self._digests.pop(card_id, {}).values())
+        return digests
+
+    def cards_for_type(self, type_id):
+        self._ensure_loaded()
+        with self._lock:
+            return [
+                card_id
+                for card_id, (card_type, _) in self._cards.items()
+                if card_type == type_id
+            ]
+
+    def cards_for_extension(self, extension_id):
+        self._ensure_loaded()
+        with self._lock:
+            return [
+                card_id
+                for card_id, (_, extension) in self._cards.items()
+                if extension == extension_id
+            ]
+
+    def cards_for_assets(self):
+        # Every spec carries the asset version, so any asset file change
+        # moves both faces of every card
+        self._ensure_loaded()
+        with self._lock:
+            return [(card_id, face) for card_id in self._cards for face in FACES]
+
+    def add_type_preview(self, type_id, digest):
+        with self._lock:
+            self._type_previews.setdefault(type_id, set()).add(digest)
+
+    def pop_type_previews(self, type_id):
+        with self._lock:
+            return self._type_previews.pop(type_id, set())
+
+    def swap_digest(self, card_id, face, digest):
+        # Returns the digest this face was cached under before, if it changed
+        with self._lock:
+            faces = self._digests.setdefault(card_id, {})
+            old_digest = faces.get(face)
+            faces[face] = digest
+        return old_digest if old_digest != digest else None
+
+
+class RenderWarmer:
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+    def enqueue(self, items):
+        for item in items:
+            self._queue.put(item)
+
+    def _run(self):
+        try:
+            sweep_card_images(assets.version)
+        except Exception:
+            logger.exception("Card image sweep failed")
+        while not self._stop.is_set():
+            try:
+                batch = {self._queue.get(timeout=settings.ASSET_CHECK_INTERVAL)}
+            except queue.Empty:
+                try:
+                    check_assets()
+                except Exception:
+                    logger.exception("Asset check failed")
+                continue
+            while len(batch) < WARM_BATCH_SIZE:
+                try:
+                    batch.add(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self.warm(batch)
+            except RenderTimeout:
+                logger.warning("Render warmer timed out")
+            except Exception:
+                # Batches cancelled by a shutdown aren't failures
+                if not self._stop.is_set():
+                    logger.exception("Render warmer failed")
+
+    def warm(self, items):
+        faces = {}
+        for card_id, face in items:
+            faces.setdefault(card_id, set()).add(face)
+        db = SessionLocal()
+        try:
+            cards = db.query(models.Card).filter(models.Card.id.in_(faces)).all()
+            specs = []
+            for card in cards:
+                card_type = card_types_cache.get(db, card.card_type)
+                if not card_type:
+                    continue
+                for face in faces[card.id]:
+                    spec = card_render_spec(card, card_type, face)
+                    note_render(card.id, spec)
+                    if not has_card_image(spec.digest):
+                        specs.append(spec)
+        finally:
+            db.close()
+        for spec, data in zip(specs, encode_cards(specs)):
+            store_card_image(spec.digest, data)
+
+
+render_index = RenderIndex()
+warmer = RenderWarmer()
+
+
+def note_render(card_id, spec):
+    old_digest = render_index.swap_digest(card_id, spec.face, spec.digest)
+    if old_digest:
+        evict_card_images(old_digest)
+
+
+def cards_changed(cards):
+    # cards: [(id, card_type, extension), ...]
+    render_index.set_cards(cards)
+    warmer.enqueue((card_id, face) for card_id, _, _ in cards for face in FACES)
+
+
+def cards_deleted(card_ids):
+    for digest in render_index.remove_cards(card_ids):
+        evict_card_images(digest)
+
+
+def note_type_preview(type_id, spec):
+    render_index.add_type_preview(type_id, spec.digest)
+
+
+def evict_type_previews(type_id):
+    for digest in render_index.pop_type_previews(type_id):
+        evict_card_images(digest)
+
+
+def types_changed(type_ids):
+    for type_id in type_ids:
+        evict_type_previews(type_id)
+        warmer.enqueue(
+            (card_id, face)
+            for card_id in render_index.cards_for_type(type_id)
+            for face in FACES
+        )
+
+
+def types_deleted(type_ids):
+    for type_id in type_ids:
+        evict_type_previews(type_id)
+        cards_deleted(render_index.cards_for_type(type_id))
+
+
+def extensions_changed(extension_ids):
+    for extension_id in extension_ids:
+        warmer.enqueue(
+            (card_id, face)
+            for card_id in render_index.cards_for_extension(extension_id)
+            for face in FACES
+        )
+
+
+def extensions_deleted(extension_ids):
+    for extension_id in extension_ids:
+        cards_deleted(render_index.cards_for_extension(extension_id))
+
+
+def check_assets():
+    if assets.reload_if_changed():
+        sweep_card_images(assets.version)
+        warmer.enqueue(render_index.cards_for_assets())
@@ -0,0 +1,94 @@
+import io
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+from PIL import Image, ImageCms
+from app.config import settings
+from app.routers.storybuilders.timing import stage
+
+FORMATS = {
+    "jpeg": ("jpeg", "image/jpeg"),
+    "tiff": ("tiff", "image/tiff"),
+}
+
+
+@dataclass(frozen=True)
+class PrintOutput:
+    # profile: ICC file name in PRINT_ICC_DIR, None for a plain CMYK conversion
+    profile: Optional[str] = settings.PRINT_ICC_PROFILE
+    format: str = "jpeg"
+    quality: int = 75
+
+    @property
+    def extension(self):
+        return FORMATS[self.format][0]
+
+    @property
+    def media_type(self):
+        return FORMATS[self.format][1]
+
+
+def available_profiles():
+    if not os.path.isdir(settings.PRINT_ICC_DIR):
+        return []
+    return sorted(
+        os.path.splitext(filename)[0]
+        for filename in os.listdir(settings.PRINT_ICC_DIR)
+        if filename.lower().endswith((".icc", ".icm"))
+    )
+
+
+def _profile_path(name):
+    for extension in (".icc", ".icm"):
+        path = os.path.join(settings.PRINT_ICC_DIR, name + extension)
+        if os.path.isfile(path):
+            return path
+    raise ValueError(f"Unknown ICC profile '{name}'")
+
+
+@lru_cache(maxsize=8)
+def cmyk_transform(name):
+    # Building a transform is expensive, do it once per profile and process
+    output_profile = ImageCms.getOpenProfile(_profile_path(name))
+    return ImageCms.buildTransform(
+        ImageCms.createProfile("sRGB"),
+        output_profile,
+        "RGB",
+        "CMYK",
+        renderingIntent=ImageCms.Intent.PERCEPTUAL,
+    )
+
+
+@lru_cache(maxsize=8)
+def icc_profile_bytes(name):
+    with open(_profile_path(name), "rb") as f:
+        return f.read()
+
+
+def new_print_sheet(size):
+    return Image.new(mode="CMYK", size=size, color=(0, 0, 0, 0))
+
+
+def paste_rgb_band(sheet, band, offset, output: PrintOutput):
+    # Only one RGB band is alive at a time next to the CMYK sheet
+    with stage("cmyk"):
+        if output.profile:
+            band = ImageCms.applyTransform(band, cmyk_transform(output.profile))
+        else:
+            band = band.convert("CMYK")
+        sheet.paste(band, offset)
+
+
+def encode_print_sheet(sheet, output: PrintOutput):
+    options = {}
+    if output.profile:
+        options["icc_profile"] = icc_profile_bytes(output.profile)
+    if output.format == "jpeg":
+        options["quality"] = output.quality
+    else:
+        options["compression"] = "tiff_lzw"
+    sheet_bytes = io.BytesIO()
+    with stage("encode"):
+        sheet.save(sheet_bytes, output.extension, **options)
+    return sheet_bytes.getvalue()
@@ -0,0 +1,133 @@
+import datetime
+import glob
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError
+from app.config import settings
+from app.routers.storybuilders.render_pool import future_result, submit_sheets
+from app.routers.storybuilders.utils import write_print_archive
+
+JOBS_DIR = "./app/routers/storybuilders/generated/jobs"
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class PrintJob:
+    def __init__(self, name, sheets):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.status = QUEUED
+        self.progress = 0
+        self.total = len(sheets)
+        self.error = None
+        self.created_at = datetime.datetime.now(datetime.timezone.utc)
+        self.finished_at = None
+        self.result_path = None
+        self.expires = None
+
+    @property
+    def filename(self):
+        return f"{self.name}.tar.gz"
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "progress": self.progress,
+            "total": self.total,
+            "error": self.error,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+        }
+
+
+class PrintJobManager:
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=settings.PRINT_JOB_WORKERS
+                )
+            return self._executor
+
+    def submit(self, name, sheets):
+        self.purge_expired()
+        job = PrintJob(name, sheets)
+        with self._lock:
+            self._jobs[job.id] = job
+        self._get_executor().submit(self._run, job, sheets)
+        return job
+
+    def get(self, job_id):
+        self.purge_expired()
+        return self._jobs.get(job_id)
+
+    def _run(self, job, sheets):
+        job.status = RUNNING
+        try:
+            futures = submit_sheets(sheets)
+            timeout = settings.RENDER_JOB_TIMEOUT * len(futures)
+            for _ in as_completed(futures, timeout=timeout):
+                job.progress += 1
+            os.makedirs(JOBS_DIR, exist_ok=True)
+            result_path = f"{JOBS_DIR}/{job.id}.tar.gz"
+            write_print_archive(
+                [future_result(future) for future in futures], result_path
+            )
+            job.result_path = result_path
+            job.status = DONE
+        except TimeoutError:
+            for future in futures:
+                future.cancel()
+            job.error = "Print rendering timed out"
+            job.status = FAILED
+        except Exception as e:
+            job.error = str(e) or e.__class__.__name__
+            job.status = FAILED
+        job.finished_at = datetime.datetime.now(datetime.timezone.utc)
+        # Finished jobs are retained for PRINT_JOB_TTL seconds
+        job.expires = time.monotonic() + settings.PRINT_JOB_TTL
+
+    def purge_expired(self):
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                job
+                for job in self._jobs.values()
+                if job.expires is not None and job.expires < now
+            ]
+            for job in expired:
+                del self._jobs[job.id]
+        for job in expired:
+            if job.result_path and os.path.isfile(job.result_path):
+                os.remove(job.result_path)
+
+    def sweep_archives(self):
+        # Archives of jobs registered in an earlier process, e.g. before a
+        # restart, are past their TTL once their file is
+        cutoff = time.time() - settings.PRINT_JOB_TTL
+        for path in glob.glob(f"{JOBS_DIR}/*"):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+
+print_jobs = PrintJobManager()
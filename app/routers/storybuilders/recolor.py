@@ -0,0 +1,67 @@
+import threading
+import numpy as np
+from PIL import Image, ImageColor
+from app.routers.storybuilders.assets import assets
+from app.routers.storybuilders.timing import stage
+
+
+def to_rgb(color):
+    if isinstance(color, str):
+        return ImageColor.getrgb(color)[:3]
+    return tuple(color)[:3]
+
+
+class Recolorer:
+    # Replaces every pixel of one key colour, keeping alpha untouched
+    def __init__(self, img, key=(32, 32, 32)):
+        self.size = img.size
+        self.key = to_rgb(key)
+        with stage("recolor"):
+            base = np.asarray(img.convert("RGBA"))
+            self._base = base.reshape(-1, 4)
+            # Flat indices of the key-colour pixels, computed once per asset
+            self._mask = np.flatnonzero(
+                np.all(self._base[:, :3] == self.key, axis=-1)
+            )
+
+    def new_buffer(self, count=None):
+        shape = self._base.shape if count is None else (count,) + self._base.shape
+        return np.empty(shape, dtype=np.uint8)
+
+    def recolor_into(self, color, out):
+        with stage("recolor"):
+            np.copyto(out, self._base)
+            out[self._mask, :3] = to_rgb(color)
+        return out
+
+    def _wrap(self, buffer):
+        w, h = self.size
+        return Image.frombuffer("RGBA", (w, h), buffer, "raw", "RGBA", 0, 1)
+
+    def recolor(self, color):
+        return self._wrap(self.recolor_into(color, self.new_buffer()))
+
+    def recolor_many(self, colors):
+        colors = np.array([to_rgb(color) for color in colors], dtype=np.uint8)
+        with stage("recolor"):
+            out = self.new_buffer(len(colors))
+            out[:] = self._base
+            # One fancy-indexed write for every colour of the batch
+            out[:, self._mask, :3] = colors[:, None, :]
+        return [self._wrap(buffer) for buffer in out]
+
+
+_recolorers = {}
+_lock = threading.Lock()
+
+
+def asset_recolorer(name, key):
+    cache_key = (name, to_rgb(key), assets.version)
+    recolorer = _recolorers.get(cache_key)
+    if recolorer is None:
+        recolorer = Recolorer(assets.image(name), key)
+        with _lock:
+            for stale in [k for k in _recolorers if k[2] != cache_key[2]]:
+                del _recolorers[stale]
+            _recolorers[cache_key] = recolorer
+    return recolorer
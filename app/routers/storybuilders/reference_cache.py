@@ -0,0 +1,139 @@
+import logging
+import select
+import threading
+import time
+from types import SimpleNamespace
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+from app import models, schemas
+from app.config import settings
+from app.database import engine
+from app.utils import collection_etag, get
+from app.routers.storybuilders.timing import stage
+
+NOTIFY_CHANNEL = "reference_cache"
+# Seconds between reloads for ids missing from the cached copy
+MISS_RELOAD_INTERVAL = 1
+
+logger = logging.getLogger(__name__)
+
+
+class ReferenceTable:
+    # Read-through copy of a small, rarely written table, rows by id
+    def __init__(self, model, fields):
+        self.model = model
+        self.fields = list(fields)
+        # (expires, etag, rows, rows by id, loaded), swapped as a whole
+        self._state = None
+
+    @property
+    def name(self):
+        return self.model.__tablename__
+
+    def _load(self, db):
+        with stage("db"):
+            etag = collection_etag(db, self.model)
+            rows = get(db, self.model, self.model.id, fields=self.fields)
+        # Attribute access, like the ORM rows they stand in for
+        by_id = {row["id"]: SimpleNamespace(**row) for row in rows}
+        loaded = time.monotonic()
+        expires = loaded + settings.REFERENCE_CACHE_TTL
+        self._state = (expires, etag, rows, by_id, loaded)
+        return self._state
+
+    def _get_state(self, db):
+        state = self._state
+        if state is None or state[0] < time.monotonic():
+            state = self._load(db)
+        return state
+
+    def rows(self, db):
+        # (etag, rows) of the whole table, ordered by id
+        _, etag, rows, _, _ = self._get_state(db)
+        return etag, rows
+
+    def get(self, db, row_id):
+        _, _, _, by_id, loaded = self._get_state(db)
+        row = by_id.get(row_id)
+        if row is None and time.monotonic() - loaded >= MISS_RELOAD_INTERVAL:
+            # May have been created by another worker since the last load.
+            # Unknown ids don't reload more than once per interval.
+            row = self._load(db)[3].get(row_id)
+        return row
+
+    def invalidate(self):
+        self._state = None
+
+
+card_types_cache = ReferenceTable(models.CardType, schemas.CardTypeResponse.__fields__)
+extensions_cache = ReferenceTable(
+    models.CardExtension, schemas.ExtensionResponse.__fields__
+)
+reference_tables = {table.name: table for table in (card_types_cache, extensions_cache)}
+
+
+def notify_enabled(bind):
+    return settings.REFERENCE_CACHE_NOTIFY and bind.dialect.name == "postgresql"
+
+
+async def reference_changed(db: AsyncSession, table: ReferenceTable):
+    # After a committed write, drops this worker's copy and tells the others
+    table.invalidate()
+    if notify_enabled(db.bind):
+        await db.execute(
+            text("SELECT pg_notify(:channel, :table)"),
+            {"channel": NOTIFY_CHANNEL, "table": table.name},
+        )
+        await db.commit()
+
+
+class ReferenceListener:
+    # Invalidates the reference tables on NOTIFY from other workers
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None and notify_enabled(engine):
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._listen()
+            except Exception:
+                logger.exception("Reference cache listener failed, reconnecting")
+                self._stop.wait(5)
+
+    def _listen(self):
+        connection = engine.raw_connection()
+        # Never handed back to the pool in autocommit mode
+        connection.detach()
+        try:
+            dbapi_connection = connection.connection
+            dbapi_connection.autocommit = True
+            cursor = dbapi_connection.cursor()
+            cursor.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            # Changes made while nobody was listening
+            for table in reference_tables.values():
+                table.invalidate()
+            while not self._stop.is_set():
+                if not select.select([dbapi_connection], [], [], 5)[0]:
+                    continue
+                dbapi_connection.poll()
+                while dbapi_connection.notifies:
+                    notify = dbapi_connection.notifies.pop(0)
+                    table = reference_tables.get(notify.payload)
+                    if table:
+                        table.invalidate()
+        finally:
+            connection.close()
+
+
+reference_listener = ReferenceListener()
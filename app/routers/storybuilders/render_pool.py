@@ -0,0 +1,107 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from app.config import settings
+from app.routers.storybuilders.assets import assets
+from app.routers.storybuilders.utils import render_card_prints
+from app.routers.storybuilders.image_cache import card_thumbnail, encode_card_image
+from app.routers.storybuilders.timing import collect_timings, merge_timings
+
+_executor = None
+_lock = threading.Lock()
+
+
+class RenderTimeout(Exception):
+    pass
+
+
+def _init_worker():
+    # Decoded once per worker rather than on its first render
+    assets.load()
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                # Forking a process that already runs threads (warmer, print
+                # jobs, the server's own) can copy a held lock into the child
+                _executor = ProcessPoolExecutor(
+                    max_workers=settings.RENDER_WORKERS,
+                    mp_context=multiprocessing.get_context("forkserver"),
+                    initializer=_init_worker,
+                )
+    return _executor
+
+
+def shutdown():
+    global _executor
+    with _lock:
+        if _executor is not None:
+            _executor.shutdown(cancel_futures=True)
+            _executor = None
+
+
+def _timed(fn, *args):
+    # Runs in a worker, the stage timings travel back with the result
+    with collect_timings() as timings:
+        result = fn(*args)
+    return result, timings
+
+
+def _submit(fn, *args):
+    return get_executor().submit(_timed, fn, *args)
+
+
+def future_result(future, timeout=None):
+    result, timings = future.result(timeout=timeout)
+    merge_timings(timings)
+    return result
+
+
+def submit_sheets(sheets):
+    return [_submit(render_card_prints, *sheet) for sheet in sheets]
+
+
+def _gather(futures):
+    # Results come back in submission order
+    try:
+        return [
+            future_result(future, settings.RENDER_JOB_TIMEOUT) for future in futures
+        ]
+    except TimeoutError:
+        for future in futures:
+            future.cancel()
+        raise RenderTimeout()
+
+
+def _iter_results(futures):
+    try:
+        for future in futures:
+            yield future_result(future, settings.RENDER_JOB_TIMEOUT)
+    except TimeoutError:
+        raise RenderTimeout()
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def iter_sheets(sheets):
+    # Submit everything now, hand results back in order as they complete
+    return _iter_results(submit_sheets(sheets))
+
+
+def render_sheets(sheets):
+    # sheets: [(name, specs, paper), ...]
+    return _gather(submit_sheets(sheets))
+
+
+def encode_cards(specs):
+    # Encoded master PNGs, ready for the image cache
+    return _gather([_submit(encode_card_image, spec) for spec in specs])
+
+
+def render_thumbnails(specs, size):
+    # Square thumbnails made from the cached masters
+    return _gather([_submit(card_thumbnail, spec, size) for spec in specs])
@@ -0,0 +1,73 @@
+import hashlib
+from dataclasses import dataclass, replace
+from typing import Optional
+from app.routers.storybuilders.assets import assets
+
+RECTO = 0
+VERSO = 1
+
+
+@dataclass(frozen=True)
+class CardRenderSpec:
+    # Everything a card render depends on, detached from the DB session
+    __slots__ = (
+        "name",
+        "difficulty",
+        "type_name",
+        "type_color",
+        "extension",
+        "face",
+        "asset_version",
+    )
+    name: str
+    difficulty: int
+    type_name: str
+    type_color: Optional[str]
+    extension: Optional[int]
+    face: int
+    asset_version: str
+
+    def __reduce__(self):
+        # Frozen slotted dataclasses can't be restored through setattr
+        return (
+            self.__class__,
+            tuple(getattr(self, field) for field in self.__slots__),
+        )
+
+    def for_face(self, face):
+        return replace(self, face=face)
+
+    @property
+    def digest(self):
+        # Content address of the render, used for cache file names and ETags
+        data = "\x1f".join(str(getattr(self, field)) for field in self.__slots__)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()[:32]
+
+
+def card_render_spec(card, card_type, face=RECTO):
+    return CardRenderSpec(
+        name=card.name,
+        difficulty=card.difficulty,
+        type_name=card_type.name,
+        type_color=card_type.color,
+        extension=getattr(card, "extension", None),
+        face=face,
+        asset_version=assets.version,
+    )
+
+
+# Type previews render a placeholder card
+TYPE_PREVIEW_NAME = "Template"
+TYPE_PREVIEW_DIFFICULTY = 3
+
+
+def type_preview_spec(card_type, face=RECTO, difficulty=TYPE_PREVIEW_DIFFICULTY):
+    return CardRenderSpec(
+        name=TYPE_PREVIEW_NAME,
+        difficulty=difficulty,
+        type_name=card_type.name,
+        type_color=card_type.color,
+        extension=None,
+        face=face,
+        asset_version=assets.version,
+    )
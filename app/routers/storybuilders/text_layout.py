@@ -0,0 +1,100 @@
+from dataclasses import dataclass
+from typing import Tuple
+from app.routers.storybuilders.assets import assets
+from app.routers.storybuilders.cache import LRUCache
+
+LINE_SPACING = 4
+HYPHEN = "-"
+ELLIPSIS = "..."
+
+
+@dataclass(frozen=True)
+class TextLayout:
+    size: int
+    # (line, (x, y)) ready to be drawn with the font at `size`
+    lines: Tuple[Tuple[str, Tuple[int, int]], ...]
+    fits: bool
+
+
+layouts = LRUCache(maxsize=4096)
+measures = LRUCache(maxsize=1024)
+
+
+def measure(text, size):
+    # Same box as draw.textbbox((0, 0), text) for a single line
+    return measures.get_or_set(
+        (text, size, assets.version), lambda: assets.font(size).getbbox(text)
+    )
+
+
+def _split_word(word, font, width):
+    # Hyphenates a word that is wider than the box on its own
+    parts = []
+    while font.getlength(word) > width and len(word) > 1:
+        cut = len(word) - 1
+        while cut > 1 and font.getlength(word[:cut] + HYPHEN) > width:
+            cut -= 1
+        parts.append(word[:cut] + HYPHEN)
+        word = word[cut:]
+    parts.append(word)
+    return parts
+
+
+def wrap_text(text, font, width):
+    lines = []
+    for paragraph in text.replace("\\n", "\n").strip().split("\n"):
+        line = ""
+        for word in paragraph.split():
+            candidate = f"{line} {word}" if line else word
+            if font.getlength(candidate) <= width:
+                line = candidate
+                continue
+            if line:
+                lines.append(line)
+            *full, line = _split_word(word, font, width)
+            lines.extend(full)
+        lines.append(line)
+    return lines
+
+
+def line_height(font):
+    # Matches ImageDraw's multiline spacing
+    return font.getbbox("A")[3] + LINE_SPACING
+
+
+def _layout(text, box, max_size, min_size, align):
+    left, top, right, bottom = box
+    width, height = right - left, bottom - top
+    # Shrink to fit, keeping the smallest size when nothing fits
+    for size in range(max_size, min_size - 1, -1):
+        font = assets.font(size)
+        lines = wrap_text(text, font, width)
+        step = line_height(font)
+        if len(lines) * step - LINE_SPACING <= height:
+            break
+    fits = len(lines) * step - LINE_SPACING <= height
+    if not fits:
+        lines = lines[: max((height + LINE_SPACING) // step, 1)]
+        lines[-1] = lines[-1].rstrip(HYPHEN) + ELLIPSIS
+    positions = []
+    for i, line in enumerate(lines):
+        x = left
+        if align == "center":
+            x = left + (width - font.getlength(line)) / 2
+        positions.append((line, (x, top + i * step)))
+    return TextLayout(size, tuple(positions), fits)
+
+
+def layout_text(text, box, max_size, min_size=None, align="left"):
+    # Memoized by everything that changes the line breaks and positions
+    min_size = min_size or max_size
+    return layouts.get_or_set(
+        (text, box, max_size, min_size, align, assets.version),
+        lambda: _layout(text, box, max_size, min_size, align),
+    )
+
+
+def draw_layout(draw, layout: TextLayout, fill=(0, 0, 0)):
+    font = assets.font(layout.size)
+    for line, position in layout.lines:
+        draw.text(position, line, fill, font=font)
@@ -0,0 +1,94 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+# Histogram upper bounds in milliseconds, the last bucket is open ended
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Stages timed while collecting for the current request: [(name, ms), ...]
+_observations = ContextVar("render_timings", default=None)
+
+
+class StageHistograms:
+    def __init__(self, buckets=BUCKETS_MS):
+        self.buckets = buckets
+        self._stages = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, ms):
+        with self._lock:
+            stage = self._stages.get(name)
+            if stage is None:
+                stage = self._stages[name] = {
+                    "count": 0,
+                    "total_ms": 0.0,
+                    "max_ms": 0.0,
+                    "counts": [0] * (len(self.buckets) + 1),
+                }
+            stage["count"] += 1
+            stage["total_ms"] += ms
+            stage["max_ms"] = max(stage["max_ms"], ms)
+            stage["counts"][bisect_left(self.buckets, ms)] += 1
+
+    def snapshot(self):
+        labels = [f"le_{bound}" for bound in self.buckets] + ["inf"]
+        with self._lock:
+            return {
+                name: {
+                    "count": stage["count"],
+                    "total_ms": round(stage["total_ms"], 3),
+                    "mean_ms": round(stage["total_ms"] / stage["count"], 3),
+                    "max_ms": round(stage["max_ms"], 3),
+                    "buckets": dict(zip(labels, stage["counts"])),
+                }
+                for name, stage in sorted(self._stages.items())
+            }
+
+    def clear(self):
+        with self._lock:
+            self._stages.clear()
+
+
+histograms = StageHistograms()
+
+
+def record(name, ms):
+    histograms.observe(name, ms)
+    observations = _observations.get()
+    if observations is not None:
+        observations.append((name, ms))
+
+
+@contextmanager
+def stage(name):
+    # Stages may nest, e.g. "render" includes the "recolor" and "text" it runs
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, (time.perf_counter() - start) * 1000)
+
+
+@contextmanager
+def collect_timings():
+    observations = []
+    token = _observations.set(observations)
+    try:
+        yield observations
+    finally:
+        _observations.reset(token)
+
+
+def merge_timings(observations):
+    # Stages timed in another process, e.g. a render worker
+    for name, ms in observations:
+        record(name, ms)
+
+
+def server_timing_header(observations):
+    totals = {}
+    for name, ms in observations:
+        totals[name] = totals.get(name, 0.0) + ms
+    return ", ".join(f"{name};dur={ms:.1f}" for name, ms in totals.items())
@@ -1,8 +1,33 @@
-from PIL import Image, ImageDraw, ImageFont, ImageColor
-from PIL.ImageChops import difference
-from sqlalchemy.orm import Session
-import numpy as np
+from PIL import Image, ImageDraw
+import io
+import tarfile
+import time
+from itertools import groupby
 from app import models
+from app.routers.storybuilders.assets import assets
+from app.routers.storybuilders.cache import LRUCache
+from app.routers.storybuilders.recolor import Recolorer, asset_recolorer
+from app.routers.storybuilders.reference_cache import card_types_cache
+from app.routers.storybuilders.specs import (
+    RECTO,
+    VERSO,
+    CardRenderSpec,
+    card_render_spec,
+)
+from app.routers.storybuilders.text_layout import draw_layout, layout_text, measure
+from app.routers.storybuilders.timing import stage
+from app.routers.storybuilders.print_color import (
+    PrintOutput,
+    encode_print_sheet,
+    new_print_sheet,
+    paste_rgb_band,
+)
+from app.routers.storybuilders.imposition import (
+    CARD_RENDER_SIZE,
+    DEFAULT_PAPER,
+    impose,
+    sheet_layout,
+)
 
 
 def rgb_to_hex(rgb):
@@ -10,31 +35,28 @@ def rgb_to_hex(rgb):
 
 
 def change_color(img, type_color, r=32, g=32, b=32):
-    data = np.array(img)  # "data" is a height x width x 4 numpy array
-    red, green, blue, alpha = data.T  # Temporarily unpack the bands for readability
+    return Recolorer(img, (r, g, b)).recolor(type_color)
 
-    # Replace white with red... (leaves alpha values alone...)
-    white_areas = (red == r) & (blue == g) & (green == b)
-    data[..., :-1][white_areas.T] = type_color  # Transpose back needed
 
-    return Image.fromarray(data)
+# Pre-composited bitmaps keyed by colour, shared by every card render
+type_backgrounds = LRUCache(maxsize=64)
+difficulty_strips = LRUCache(maxsize=256)
 
 
-def generate_type_card(card_type):
+def render_type_background(color, contour=None):
     card = Image.new(mode="RGB", size=(400, 400), color=(255, 255, 255, 255))
-    contour = Image.open("./app/routers/storybuilders/assets/Contour.png")
-    if card_type.color:
-        contour = change_color(contour, ImageColor.getrgb(card_type.color))
+    if contour is None:
+        if color:
+            contour = asset_recolorer("contour", (32, 32, 32)).recolor(color)
+        else:
+            contour = assets.image("contour")
     card.paste(contour, (0, 0))
     return card
 
 
-def generate_difficulty(difficulty, card_type):
-    difficulty_img = Image.open("./app/routers/storybuilders/assets/Difficulty10X.png")
+def render_difficulty(difficulty, color):
+    difficulty_img = asset_recolorer("difficulty", (255, 255, 255)).recolor(color)
     difficulty_img_w, difficulty_img_h = difficulty_img.size
-    difficulty_img = change_color(
-        difficulty_img, ImageColor.getrgb(card_type.color), 255, 255, 255
-    )
     difficulty_total = Image.new(
         mode="RGB",
         size=((difficulty_img_w) * difficulty, difficulty_img_h),
@@ -50,169 +72,209 @@ def generate_difficulty(difficulty, card_type):
     return difficulty_total
 
 
-def create_card_text(text, draw, font, card_w, card_h, iterator=0):
-    right = 100 + draw.textlength(text, font=font)
-    print(right < card_w)
-    if right < card_w:
-
-        return
-    texts = [
-        text[: int(len(text) / 2)],
-        text[int(len(text) / 2) :],
+def preload_type_backgrounds(colors):
+    # Recolour the contour for every missing colour in one batch
+    colors = [
+        color
+        for color in dict.fromkeys(colors)
+        if color and (color, assets.version) not in type_backgrounds
     ]
-    i = iterator
-    for t in texts:
-        create_card_text(t, draw, font, card_w, card_h, i)
-        i += 1
+    if not colors:
+        return
+    contours = asset_recolorer("contour", (32, 32, 32)).recolor_many(colors)
+    for color, contour in zip(colors, contours):
+        type_backgrounds.set(
+            (color, assets.version), render_type_background(color, contour)
+        )
 
 
-def generate_recto_card(card, card_type):
-    # Card canvas
-    card_img = generate_type_card(card_type)
-    # Card type
-    font_title = ImageFont.truetype(
-        "./app/routers/storybuilders/assets/fonts/Chewy-Regular.ttf", 34
+def generate_type_card(spec: CardRenderSpec):
+    # Callers draw on the card, so hand out a copy of the cached background
+    background = type_backgrounds.get_or_set(
+        (spec.type_color, spec.asset_version),
+        lambda: render_type_background(spec.type_color),
     )
-    font_text = ImageFont.truetype(
-        "./app/routers/storybuilders/assets/fonts/Chewy-Regular.ttf", 29
+    return background.copy()
+
+
+def generate_difficulty(spec: CardRenderSpec):
+    # Read-only: only ever pasted onto a card
+    return difficulty_strips.get_or_set(
+        (spec.difficulty, spec.type_color, spec.asset_version),
+        lambda: render_difficulty(spec.difficulty, spec.type_color),
     )
+
+
+# Card name area, above the difficulty strip
+CARD_TEXT_BOX = (50, 85, 350, 320)
+CARD_TEXT_SIZES = (29, 18)
+
+
+def generate_recto_card(spec: CardRenderSpec):
+    # Card canvas
+    card_img = generate_type_card(spec)
+    # Card type
     draw = ImageDraw.Draw(card_img)
     card_w, card_h = card_img.size
-    _, _, type_box_w, _ = draw.textbbox((0, 0), card_type.name, font=font_title)
-    draw.text(
-        ((card_w - type_box_w) / 2, 20),
-        card_type.name,
-        (0, 0, 0),
-        font=font_title,
-    )
+    with stage("text"):
+        _, _, type_box_w, _ = measure(spec.type_name, 34)
+        draw.text(
+            ((card_w - type_box_w) / 2, 20),
+            spec.type_name,
+            (0, 0, 0),
+            font=assets.font(34),
+        )
     # Separator 1
-    separator = Image.open("./app/routers/storybuilders/assets/CardSeparator2X.png")
-    separator_w, separator_h = separator.size
-    separator = separator.resize((separator_w + 45, separator_h))
+    separator = assets.image("separator")
     separator_w, separator_h = separator.size
     separator_offset = (int(card_w / 2) - int(separator_w / 2), 25 + separator_h + 30)
     card_img.paste(separator, separator_offset, separator)
     # Card Text
-    # create_card_text(card.name.replace("\\n", "\n"), draw, font, card_w, card_h)
-    _, _, text_box_w, text_box_h = draw.textbbox(
-        (0, 40), card.name.replace("\\n", "\n"), font=font_text
-    )
-    draw.text(
-        (
-            50,
-            85,
-        ),
-        card.name.replace("\\n", "\n").strip(),
-        (0, 0, 0),
-        font=font_text,
-    )
+    with stage("text"):
+        draw_layout(draw, layout_text(spec.name, CARD_TEXT_BOX, *CARD_TEXT_SIZES))
     # Card Difficulty
-    difficulty_img = generate_difficulty(card.difficulty, card_type)
+    difficulty_img = generate_difficulty(spec)
     _, difficulty_img_h = difficulty_img.size
     card_img.paste(
-        generate_difficulty(card.difficulty, card_type),
+        difficulty_img,
         (int(card_w / 5) + 20, card_h - difficulty_img_h - 20),
     )
     return card_img
 
 
-def generate_verso_card(card, card_type):
+def generate_verso_card(spec: CardRenderSpec):
     # Card canvas
-    card_img = generate_type_card(card_type)
-    logo = Image.open("./app/routers/storybuilders/assets/Logo2X.png")
+    card_img = generate_type_card(spec)
+    logo = assets.image("logo")
     logo_w, logo_h = logo.size
     img_offset = (15, (400 - logo_h) // 2)
     card_img.paste(logo, img_offset, logo)
-    font = ImageFont.truetype(
-        "./app/routers/storybuilders/assets/fonts/Chewy-Regular.ttf", 45
-    )
     # Type Text
     draw = ImageDraw.Draw(card_img)
     card_w, card_h = card_img.size
-    _, _, w, h = draw.textbbox((0, 0), card_type.name, font=font)
-    draw.text(
-        ((card_w - w) / 2, (card_h - h) / 3 - 20),
-        card_type.name,
-        (0, 0, 0),
-        font=font,
-    )
+    with stage("text"):
+        _, _, w, h = measure(spec.type_name, 45)
+        draw.text(
+            ((card_w - w) / 2, (card_h - h) / 3 - 20),
+            spec.type_name,
+            (0, 0, 0),
+            font=assets.font(45),
+        )
     # Card Difficulty
-    difficulty_img = generate_difficulty(card.difficulty, card_type)
+    difficulty_img = generate_difficulty(spec)
     _, difficulty_img_h = difficulty_img.size
     card_img.paste(
-        generate_difficulty(card.difficulty, card_type),
+        difficulty_img,
         (int(card_w / 5) + 20, card_h - difficulty_img_h - int(card_h / 4)),
     )
     return card_img
 
 
-anchors_recto = {
-    1: (int(1691 / 4) * 1 - 400, 50),
-    2: (int(1691 / 4) * 2 - 400, 50),
-    3: (int(1691 / 4) * 3 - 400, 50),
-    4: (int(1691 / 4) * 4 - 400, 50),
-    5: (int(1691 / 4) * 1 - 400, 50 + int(2178 / 4) * 1),
-    6: (int(1691 / 4) * 2 - 400, 50 + int(2178 / 4) * 1),
-    7: (int(1691 / 4) * 3 - 400, 50 + int(2178 / 4) * 1),
-    8: (int(1691 / 4) * 4 - 400, 50 + int(2178 / 4) * 1),
-    9: (int(1691 / 4) * 1 - 400, 50 + int(2178 / 4) * 2),
-    10: (int(1691 / 4) * 2 - 400, 50 + int(2178 / 4) * 2),
-    11: (int(1691 / 4) * 3 - 400, 50 + int(2178 / 4) * 2),
-    12: (int(1691 / 4) * 4 - 400, 50 + int(2178 / 4) * 2),
-    13: (int(1691 / 4) * 1 - 400, 50 + int(2178 / 4) * 3),
-    14: (int(1691 / 4) * 2 - 400, 50 + int(2178 / 4) * 3),
-    15: (int(1691 / 4) * 3 - 400, 50 + int(2178 / 4) * 3),
-    16: (int(1691 / 4) * 4 - 400, 50 + int(2178 / 4) * 3),
-}
-
-anchors_verso = {
-    1: (1691 - int(1691 / 4) * 1, 50),
-    2: (1691 - int(1691 / 4) * 2, 50),
-    3: (1691 - int(1691 / 4) * 3, 50),
-    4: (1691 - int(1691 / 4) * 4, 50),
-    5: (1691 - int(1691 / 4) * 1, 50 + int(2178 / 4) * 1),
-    6: (1691 - int(1691 / 4) * 2, 50 + int(2178 / 4) * 1),
-    7: (1691 - int(1691 / 4) * 3, 50 + int(2178 / 4) * 1),
-    8: (1691 - int(1691 / 4) * 4, 50 + int(2178 / 4) * 1),
-    9: (1691 - int(1691 / 4) * 1, 50 + int(2178 / 4) * 2),
-    10: (1691 - int(1691 / 4) * 2, 50 + int(2178 / 4) * 2),
-    11: (1691 - int(1691 / 4) * 3, 50 + int(2178 / 4) * 2),
-    12: (1691 - int(1691 / 4) * 4, 50 + int(2178 / 4) * 2),
-    13: (1691 - int(1691 / 4) * 1, 50 + int(2178 / 4) * 3),
-    14: (1691 - int(1691 / 4) * 2, 50 + int(2178 / 4) * 3),
-    15: (1691 - int(1691 / 4) * 3, 50 + int(2178 / 4) * 3),
-    16: (1691 - int(1691 / 4) * 4, 50 + int(2178 / 4) * 3),
-}
-
-
-def generate_card_prints(start_id, end_id, db):
-    recto_name = f"./app/routers/storybuilders/generated/prints/cards_{start_id}_{end_id}_recto.jpeg"
-    verso_name = f"./app/routers/storybuilders/generated/prints/cards_{start_id}_{end_id}_verso.jpeg"
-    # Planche d'impression
-    recto = Image.new(mode="RGBA", size=(1691, 2178), color=(255, 255, 255))
-    verso = Image.new(mode="RGBA", size=(1691, 2178), color=(255, 255, 255))
-    # Get data
-    cards = (
-        db.query(models.Card, models.CardType, models.CardExtension)
-        .join(models.CardType, models.CardExtension)
-        .filter(models.Card.id >= start_id, models.Card.id <= end_id)
-        .all()
-    )
-    i = 0
+def render_card(spec: CardRenderSpec):
+    if spec.asset_version != assets.version:
+        # Render workers pick up asset changes made after they started
+        assets.reload_if_changed()
+    with stage("render"):
+        if spec.face == RECTO:
+            return generate_recto_card(spec)
+        return generate_verso_card(spec)
+
+
+def get_card_print_specs(
+    db, start_id=None, end_id=None, extension=None, card_type=None, ids=None
+):
+    query = db.query(models.Card)
+    if start_id is not None:
+        query = query.filter(models.Card.id >= start_id)
+    if end_id is not None:
+        query = query.filter(models.Card.id <= end_id)
+    if extension is not None:
+        query = query.filter(models.Card.extension == extension)
+    if card_type is not None:
+        query = query.filter(models.Card.card_type == card_type)
+    if ids:
+        query = query.filter(models.Card.id.in_(ids))
+    with stage("db"):
+        cards = query.order_by(models.Card.id).all()
+    specs = []
     for card in cards:
-        if card:
-            i += 1
-            verso.paste(generate_verso_card(card[0], card[1]), anchors_verso[i])
-            recto.paste(generate_recto_card(card[0], card[1]), anchors_recto[i])
-    recto.convert("CMYK").save(recto_name)
-    verso.convert("CMYK").save(verso_name)
+        card_type = card_types_cache.get(db, card.card_type)
+        if card_type:
+            specs.append((card.id, card_render_spec(card, card_type)))
+    return specs
+
+
+def render_card_prints(name, specs, paper=DEFAULT_PAPER, output=PrintOutput()):
+    layout = sheet_layout(paper)
+    sheet_w, _ = layout.size
+    card_size = (layout.card_size, layout.card_size)
+    band_size = (sheet_w, layout.card_size)
+    # Planche d'impression, composed one row of cards at a time
+    recto = new_print_sheet(layout.size)
+    verso = new_print_sheet(layout.size)
+    # Both faces use the type background, recolour the sheet's types at once
+    preload_type_backgrounds(spec.type_color for spec in specs)
+    slots = zip(specs, layout.recto_slots, layout.verso_slots)
+    for top, row in groupby(slots, key=lambda slot: slot[1][1]):
+        recto_band = Image.new(mode="RGB", size=band_size, color=(255, 255, 255))
+        verso_band = Image.new(mode="RGB", size=band_size, color=(255, 255, 255))
+        for spec, (recto_x, _), (verso_x, _) in row:
+            recto_img = render_card(spec.for_face(RECTO))
+            verso_img = render_card(spec.for_face(VERSO))
+            if layout.card_size != CARD_RENDER_SIZE:
+                recto_img = recto_img.resize(card_size, Image.LANCZOS)
+                verso_img = verso_img.resize(card_size, Image.LANCZOS)
+            recto_band.paste(recto_img, (recto_x, 0))
+            verso_band.paste(verso_img, (verso_x, 0))
+        paste_rgb_band(recto, recto_band, (0, top), output)
+        paste_rgb_band(verso, verso_band, (0, top), output)
     return (
-        (
-            f"cards_{start_id}_{end_id}_recto.jpeg",
-            f"./app/routers/storybuilders/generated/prints/cards_{start_id}_{end_id}_recto.jpeg",
-        ),
-        (
-            f"cards_{start_id}_{end_id}_verso.jpeg",
-            f"./app/routers/storybuilders/generated/prints/cards_{start_id}_{end_id}_verso.jpeg",
-        ),
+        (f"{name}_recto.{output.extension}", encode_print_sheet(recto, output)),
+        (f"{name}_verso.{output.extension}", encode_print_sheet(verso, output)),
     )
+
+
+def get_print_sheets(db, paper=DEFAULT_PAPER, output=PrintOutput(), **filters):
+    # Sheets are (name, specs, paper, output), packed densely in card id order
+    sheets = []
+    for cards in impose(get_card_print_specs(db, **filters), paper):
+        name = f"cards_{cards[0][0]}_{cards[-1][0]}"
+        sheets.append((name, [spec for _, spec in cards], paper, output))
+    return sheets
+
+
+class _ChunkSink:
+    # Write-only file object collecting the compressed tar blocks
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self):
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_print_archive(card_prints):
+    # Yields tar.gz blocks as soon as each sheet is available
+    sink = _ChunkSink()
+    with tarfile.open(fileobj=sink, mode="w|gz") as tar:
+        for sheet in card_prints:
+            for name, data in sheet:
+                tar_info = tarfile.TarInfo(name)
+                tar_info.size = len(data)
+                tar_info.mtime = int(time.time())
+                tar.addfile(tar_info, io.BytesIO(data))
+            chunk = sink.pop()
+            if chunk:
+                yield chunk
+    yield sink.pop()
+
+
+def write_print_archive(card_prints, f_name):
+    with open(f_name, "wb") as f:
+        for chunk in stream_print_archive(card_prints):
+            f.write(chunk)
@@ -1,7 +1,7 @@
 from datetime import datetime
 import uuid
-from typing import List
-from pydantic import BaseModel, EmailStr, constr
+from typing import Dict, List
+from pydantic import BaseModel, EmailStr, conint, constr
 from pydantic.schema import Optional
 
 # Default
@@ -19,6 +19,11 @@ class DefaultResponse(BaseModel):
     message: str
 
 
+class ConflictResponse(DefaultResponse):
+    # Every submitted item whose name is already taken
+    conflicts: List[dict]
+
+
 # User
 
 
@@ -83,6 +88,12 @@ class CardTypeResponseCollection(BaseModel):
     __root__: List[CardTypeResponse]
 
 
+class CardTypeEditResponse(BaseModel):
+    updated: List[CardTypeResponse]
+    unchanged: List[int]
+    not_found: List[int]
+
+
 # Extension
 class ExtensionBaseSchema(BaseModel):
     name: str
@@ -103,6 +114,12 @@ class ExtensionResponseCollection(BaseModel):
     __root__: List[ExtensionResponse]
 
 
+class ExtensionEditResponse(BaseModel):
+    updated: List[ExtensionResponse]
+    unchanged: List[int]
+    not_found: List[int]
+
+
 # Card
 
 
@@ -127,3 +144,43 @@ class CardResponse(CardBaseSchema):
 
 class CardCollection(BaseModel):
     __root__: List[CardResponse]
+
+
+class CardEditResponse(BaseModel):
+    updated: List[CardResponse]
+    unchanged: List[int]
+    not_found: List[int]
+
+
+class CardAtlas(BaseModel):
+    key: str
+    image: str
+    width: int
+    height: int
+    # card id: [x, y, width, height]
+    rects: Dict[int, List[int]]
+
+
+# Print jobs
+
+
+class PrintJobCreate(BaseModel):
+    start_id: Optional[int]
+    end_id: Optional[int]
+    extension: Optional[int]
+    card_type: Optional[int]
+    ids: Optional[List[int]]
+    paper: str = "letter"
+    output_profile: Optional[str]
+    format: str = "jpeg"
+    quality: conint(ge=1, le=100) = 75
+
+
+class PrintJobResponse(BaseModel):
+    id: str
+    status: str
+    progress: int
+    total: int
+    error: Optional[str]
+    created_at: datetime
+    finished_at: Optional[datetime]
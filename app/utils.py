@@ -1,9 +1,18 @@
+import logging
+import uuid
+from fastapi import HTTPException, status
 from passlib.context import CryptContext
+from sqlalchemy import bindparam, insert, inspect, select, update
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from typing import List
 from app import models, schemas
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+logger = logging.getLogger(__name__)
+# Rows per INSERT, a multi-row VALUES binds one parameter per column and row
+# and asyncpg accepts at most 32767
+INSERT_CHUNK_SIZE = 1000
 
 
 def hash_password(password: str):
@@ -14,58 +23,240 @@ def verify_password(password: str, hashed_password: str):
     return pwd_context.verify(password, hashed_password)
 
 
+def etag_matches(if_none_match, etag):
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return any(tag.removeprefix("W/") == etag for tag in tags)
+
+
+# Collections whose lists are served with an ETag
+VERSIONED_MODELS = (models.Card, models.CardType, models.CardExtension)
+
+
+def create_collection_versions(bind):
+    # There are no migrations, so the table behind the list ETags is created on
+    # startup. By hand: CREATE TABLE collection_versions
+    # (name VARCHAR PRIMARY KEY, version VARCHAR NOT NULL)
+    try:
+        models.CollectionVersion.__table__.create(bind=bind, checkfirst=True)
+    except DBAPIError:
+        # Another worker starting at the same time created it first
+        if not inspect(bind).has_table(models.CollectionVersion.__tablename__):
+            raise
+    # One row per collection up front, so writes only ever update it
+    for model in VERSIONED_MODELS:
+        try:
+            with bind.begin() as connection:
+                seeded = connection.execute(
+                    select(models.CollectionVersion.name).where(
+                        models.CollectionVersion.name == model.__tablename__
+                    )
+                ).first()
+                if not seeded:
+                    connection.execute(
+                        insert(models.CollectionVersion).values(
+                            name=model.__tablename__, version=uuid.uuid4().hex
+                        )
+                    )
+        except IntegrityError:
+            # Seeded by another worker starting at the same time
+            pass
+
+
+def create_card_indexes(bind):
+    # Created on startup like collection_versions, the keyset pages and
+    # name prefix filters of the card list rely on them
+    for index in models.Card.__table__.indexes:
+        try:
+            index.create(bind=bind, checkfirst=True)
+        except DBAPIError:
+            # Another worker starting at the same time created it first
+            indexes = inspect(bind).get_indexes(models.Card.__tablename__)
+            if index.name not in {existing["name"] for existing in indexes}:
+                raise
+
+
+def collection_etag(db: Session, model):
+    result = db.execute(
+        select(models.CollectionVersion.version).where(
+            models.CollectionVersion.name == model.__tablename__
+        )
+    )
+    return f'"{model.__tablename__}-{result.scalar() or 0}"'
+
+
+def collection_headers(etag):
+    # Clients keep the list and revalidate it on every use
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
+
+async def bump_version(db: AsyncSession, model):
+    # Random rather than a counter, so a recreated table never repeats an ETag.
+    # The row was seeded on startup, concurrent writers only queue on its lock.
+    await db.execute(
+        update(models.CollectionVersion)
+        .where(models.CollectionVersion.name == model.__tablename__)
+        .values(version=uuid.uuid4().hex)
+    )
+
+
 class APIException(Exception):
     def __init__(self, item: object) -> None:
         self.item = item
         super().__init__()
 
 
-def get(db: Session, model: models.CustomBase, order_by=None, filter_by=None):
-    query = db.query(model)
-    if order_by:
+async def find_conflicts(
+    db: AsyncSession, model, items, unique_field="name", key_field=None
+):
+    # Items clashing with a stored row or with an earlier item of the batch.
+    # With key_field, a stored row doesn't clash with its own edit.
+    column = getattr(model, unique_field)
+    key_column = getattr(model, key_field) if key_field else column
+    values = [item[unique_field] for item in items]
+    result = await db.execute(select(column, key_column).where(column.in_(values)))
+    owners = dict(result.all())
+    seen = set()
+    conflicts = []
+    for item in items:
+        value = item[unique_field]
+        if value in owners and (not key_field or owners[value] != item[key_field]):
+            conflicts.append(item)
+        elif value in seen:
+            conflicts.append(item)
+        seen.add(value)
+    return conflicts
+
+
+async def integrity_error(
+    db: AsyncSession, error, model, items, unique_field="name", key_field=None
+):
+    # What to raise for a write the conflict check let through. A name taken
+    # by a concurrent write is a conflict, anything else (an unknown foreign
+    # key, a missing value) is a bad request.
+    logger.warning("Write to %s failed: %s", model.__tablename__, error.orig)
+    await db.rollback()
+    conflicts = await find_conflicts(db, model, items, unique_field, key_field)
+    if conflicts:
+        return APIException(conflicts)
+    return HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST, detail=str(error.orig)
+    )
+
+
+def get(
+    db: Session,
+    model: models.CustomBase,
+    order_by=None,
+    filter_by=None,
+    fields=None,
+    limit=None,
+):
+    # Plain dicts of the selected columns, no ORM instances are built
+    columns = model.__table__.columns
+    if fields:
+        columns = [columns[field] for field in fields]
+    query = select(*columns)
+    if order_by is not None:
         query = query.order_by(order_by)
-    if filter_by:
-        query = query.filter(filter_by)
-    datas: List[models.CustomBase] = query.all()
-    return [data.to_dict() for data in datas]
+    if filter_by is not None:
+        query = query.where(filter_by)
+    if limit is not None:
+        query = query.limit(limit)
+    result = db.execute(query)
+    keys = list(result.keys())
+    return [dict(zip(keys, row)) for row in result]
 
 
-def create(db: Session, model, datas):
+async def insert_rows(db: AsyncSession, model, items, unique_field="name"):
+    # The stored rows of items, in order
+    columns = model.__table__.columns
+    if db.bind.dialect.full_returning:
+        result = await db.execute(insert(model).values(items).returning(*columns))
+        return [dict(row._mapping) for row in result]
+    await db.execute(insert(model), items)
+    column = getattr(model, unique_field)
+    result = await db.execute(
+        select(*columns).where(column.in_([item[unique_field] for item in items]))
+    )
+    rows = {row._mapping[unique_field]: dict(row._mapping) for row in result}
+    return [rows[item[unique_field]] for item in items]
+
+
+async def create(db: AsyncSession, model, datas, unique_field="name"):
+    # One conflict check and one INSERT per chunk of the batch, all in one
+    # transaction, raises APIException with every conflicting item
+    items = datas["__root__"]
+    if not items:
+        return []
+    conflicts = await find_conflicts(db, model, items, unique_field)
+    if conflicts:
+        raise APIException(conflicts)
     new_items = []
-    for data in datas["__root__"]:
-        new_item = model(**data)
-        new_items.append(new_item)
-        db.add(new_item)
-        try:
-            db.flush()
-        except Exception as e:
-            print(e.args)
-            print(e)
-            raise APIException(data)
-    db.commit()
-    map(lambda new_item: db.refresh(new_item), new_items)
+    try:
+        for start in range(0, len(items), INSERT_CHUNK_SIZE):
+            chunk = items[start : start + INSERT_CHUNK_SIZE]
+            new_items.extend(await insert_rows(db, model, chunk, unique_field))
+    except IntegrityError as e:
+        raise await integrity_error(db, e, model, items, unique_field)
+    await bump_version(db, model)
+    await db.commit()
     return new_items
 
 
-def edit(db: Session, model: models.CustomBase, datas, filter_field):
-    items = []
-    for data in datas["__root__"]:
-        filter_by = object.__getattribute__(model, filter_field) == data[filter_field]
-        item: models.CustomBase = db.query(model).filter(filter_by).first()
-        if item.to_dict() != data:
-            item.update(data)
-            items.append(item)
-            try:
-                db.flush()
-            except:
-                raise APIException(data)
-    db.commit()
-    map(lambda new_item: db.refresh(new_item), items)
-    return {"__root__": items}
-
-
-def delete(db: Session, model: models.CustomBase, filter_by):
-    item = db.query(model).filter(filter_by).first()
-    db.delete(item)
-    db.commit()
+async def edit(
+    db: AsyncSession, model: models.CustomBase, datas, filter_field, unique_field="name"
+):
+    # One IN select, the diff in memory, then one executemany UPDATE
+    items = datas["__root__"]
+    column = getattr(model, filter_field)
+    keys = [data[filter_field] for data in items]
+    result = await db.execute(select(*model.__table__.columns).where(column.in_(keys)))
+    rows = {row._mapping[filter_field]: dict(row._mapping) for row in result}
+    updated, unchanged, not_found = [], [], []
+    for data in items:
+        row = rows.get(data[filter_field])
+        if row is None:
+            not_found.append(data[filter_field])
+        elif all(row[key] == value for key, value in data.items() if key in row):
+            unchanged.append(data[filter_field])
+        else:
+            row.update((key, value) for key, value in data.items() if key in row)
+            updated.append(row)
+    if updated:
+        conflicts = await find_conflicts(db, model, updated, unique_field, filter_field)
+        if conflicts:
+            raise APIException(conflicts)
+        fields = [key for key in updated[0] if key != filter_field]
+        statement = (
+            update(model)
+            .where(column == bindparam("_key"))
+            .values({key: bindparam(f"_{key}") for key in fields})
+        )
+        params = [
+            {"_key": row[filter_field], **{f"_{key}": row[key] for key in fields}}
+            for row in updated
+        ]
+        try:
+            await db.execute(statement, params)
+        except IntegrityError as e:
+            raise await integrity_error(
+                db, e, model, updated, unique_field, filter_field
+            )
+        await bump_version(db, model)
+    await db.commit()
+    return {"updated": updated, "unchanged": unchanged, "not_found": not_found}
+
+
+async def delete(db: AsyncSession, model: models.CustomBase, filter_by):
+    result = await db.execute(select(model).where(filter_by))
+    row = result.scalars().first()
+    if row is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Not found")
+    await db.delete(row)
+    await bump_version(db, model)
+    await db.commit()
     return {"message": "Deleted"}
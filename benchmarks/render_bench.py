@@ -0,0 +1,261 @@
+"""Card renderer benchmarks, no database needed.
+
+    python -m benchmarks.render_bench run --output benchmarks/baseline.json
+    python -m benchmarks.render_bench compare benchmarks/baseline.json --threshold 0.2
+
+Every benchmark runs in its own process so peak RSS is per benchmark.
+compare exits with status 1 when a metric regresses past the threshold.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+import tracemalloc
+
+# Settings are read at import time, the renderer doesn't use any of them
+for _name, _value in {
+    "DATABASE_PORT": "5432",
+    "POSTGRES_PASSWORD": "bench",
+    "POSTGRES_USER": "bench",
+    "POSTGRES_DB": "bench",
+    "POSTGRES_HOST": "localhost",
+    "POSTGRES_HOSTNAME": "localhost",
+    "JWT_SECRET_KEY": "YmVuY2g=",
+    "REFRESH_TOKEN_EXPIRES_IN": "60",
+    "ACCESS_TOKEN_EXPIRES_IN": "15",
+    "JWT_ALGORITHM": "HS256",
+    "CLIENT_ORIGIN": "http://localhost",
+}.items():
+    os.environ.setdefault(_name, _value)
+
+METRICS = ("wall_ms", "peak_rss_kb", "alloc_peak_kb", "alloc_blocks")
+# Differences below these are noise, whatever the ratio
+NOISE_FLOORS = {
+    "wall_ms": 0.1,
+    "peak_rss_kb": 2048,
+    "alloc_peak_kb": 16,
+    "alloc_blocks": 64,
+}
+TYPES = [
+    ("Action", "#e8590c"),
+    ("Mime", "#1c7ed6"),
+    ("Dessin", "#2f9e44"),
+    ("Question", "#ae3ec9"),
+    ("Bonus", "#f08c00"),
+]
+
+
+def synthetic_specs(count):
+    from app.routers.storybuilders.assets import assets
+    from app.routers.storybuilders.specs import CardRenderSpec
+
+    return [
+        CardRenderSpec(
+            name=f"Carte numero {i} avec un titre un peu long",
+            difficulty=i % 5 + 1,
+            type_name=TYPES[i % len(TYPES)][0],
+            type_color=TYPES[i % len(TYPES)][1],
+            extension=1,
+            face=0,
+            asset_version=assets.version,
+        )
+        for i in range(count)
+    ]
+
+
+def clear_caches():
+    from app.routers.storybuilders import utils, text_layout
+
+    utils.type_backgrounds.clear()
+    utils.difficulty_strips.clear()
+    text_layout.layouts.clear()
+    text_layout.measures.clear()
+
+
+def bench_change_color():
+    from app.routers.storybuilders.assets import assets
+    from app.routers.storybuilders.utils import change_color
+
+    contour = assets.image("contour")
+    return lambda: change_color(contour, (232, 89, 12))
+
+
+def bench_type_card():
+    from app.routers.storybuilders.utils import generate_type_card
+
+    spec = synthetic_specs(1)[0]
+    return lambda: generate_type_card(spec)
+
+
+def bench_type_card_cold():
+    from app.routers.storybuilders.utils import generate_type_card
+
+    spec = synthetic_specs(1)[0]
+
+    def run():
+        clear_caches()
+        generate_type_card(spec)
+
+    return run
+
+
+def bench_difficulty():
+    from app.routers.storybuilders.utils import generate_difficulty
+
+    spec = synthetic_specs(1)[0]
+    return lambda: generate_difficulty(spec)
+
+
+def bench_recto_card():
+    from app.routers.storybuilders.utils import generate_recto_card
+
+    spec = synthetic_specs(1)[0]
+    return lambda: generate_recto_card(spec)
+
+
+def bench_verso_card():
+    from app.routers.storybuilders.utils import generate_verso_card
+
+    spec = synthetic_specs(1)[0].for_face(1)
+    return lambda: generate_verso_card(spec)
+
+
+def bench_recto_card_cold():
+    from app.routers.storybuilders.utils import generate_recto_card
+
+    spec = synthetic_specs(1)[0]
+
+    def run():
+        clear_caches()
+        generate_recto_card(spec)
+
+    return run
+
+
+def bench_sheet_16():
+    from app.routers.storybuilders.utils import render_card_prints
+
+    specs = synthetic_specs(16)
+    return lambda: render_card_prints("bench", specs)
+
+
+def bench_deck_500():
+    from app.routers.storybuilders.imposition import impose
+    from app.routers.storybuilders.utils import render_card_prints
+
+    sheets = impose(synthetic_specs(500))
+
+    def run():
+        for i, specs in enumerate(sheets):
+            render_card_prints(f"bench_{i}", specs)
+
+    return run
+
+
+# name: (setup returning the measured callable, default repeat)
+BENCHMARKS = {
+    "change_color": (bench_change_color, 50),
+    "generate_type_card": (bench_type_card, 200),
+    "generate_type_card_cold": (bench_type_card_cold, 20),
+    "generate_difficulty": (bench_difficulty, 200),
+    "generate_recto_card": (bench_recto_card, 50),
+    "generate_verso_card": (bench_verso_card, 50),
+    "generate_recto_card_cold": (bench_recto_card_cold, 20),
+    "card_prints_16": (bench_sheet_16, 5),
+    "deck_500": (bench_deck_500, 1),
+}
+
+
+def _run_one(name, repeat, results):
+    setup, default_repeat = BENCHMARKS[name]
+    run = setup()
+    # Warm up the asset registry and the caches a real worker would have
+    run()
+    timings = []
+    for _ in range(repeat or default_repeat):
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) * 1000)
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    run()
+    _, alloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    results[name] = {
+        "wall_ms": round(statistics.median(timings), 3),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "alloc_peak_kb": round(alloc_peak / 1024, 1),
+        "alloc_blocks": max(sys.getallocatedblocks() - blocks, 0),
+    }
+
+
+def run_benchmarks(names, repeat=None):
+    context = multiprocessing.get_context("spawn")
+    with context.Manager() as manager:
+        results = manager.dict()
+        for name in names:
+            process = context.Process(target=_run_one, args=(name, repeat, results))
+            process.start()
+            process.join()
+            if process.exitcode:
+                raise RuntimeError(f"Benchmark '{name}' failed")
+            print(f"{name:28} " + "  ".join(f"{m}={results[name][m]}" for m in METRICS))
+        return {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": dict(results),
+        }
+
+
+def compare(baseline, current, threshold):
+    regressions = []
+    for name, metrics in current["results"].items():
+        base = baseline["results"].get(name)
+        if not base:
+            continue
+        for metric in METRICS:
+            if not base.get(metric):
+                continue
+            if metrics[metric] - base[metric] <= NOISE_FLOORS[metric]:
+                continue
+            if metrics[metric] > base[metric] * (1 + threshold):
+                regressions.append(
+                    f"{name}.{metric}: {base[metric]} -> {metrics[metric]} "
+                    f"(+{(metrics[metric] / base[metric] - 1) * 100:.0f}%)"
+                )
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+    run_parser = commands.add_parser("run")
+    compare_parser = commands.add_parser("compare")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("--threshold", type=float, default=0.2)
+    for command in (run_parser, compare_parser):
+        command.add_argument("--output")
+        command.add_argument("--repeat", type=int)
+        command.add_argument("--only", nargs="+", choices=sorted(BENCHMARKS))
+    args = parser.parse_args(argv)
+
+    current = run_benchmarks(args.only or list(BENCHMARKS), args.repeat)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(current, f, indent=2)
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            regressions = compare(json.load(f), current, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())